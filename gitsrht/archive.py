@@ -0,0 +1,611 @@
+import fcntl
+import hashlib
+import io
+import json
+import os
+import pygit2
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from gitsrht.cache import LRUCache
+from srht.cache import get_cache, set_cache
+from srht.config import cfg
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_archive_dir = cfg("git.sr.ht", "archive-cache", default="")
+_archive_size = int(cfg("git.sr.ht", "archive-cache-size",
+    default=str(10 << 30)))
+# Temporary files of builds older than this were abandoned by a dead worker
+_stale_build = 60 * 60
+_lock_timeout = int(cfg("git.sr.ht", "archive-lock-timeout", default="30"))
+
+def archive_key(object_id, prefix, fmt):
+    """
+    Returns the cache key of the archive of a commit or tree with the given
+    prefix and format, which is also used as its ETag.
+    """
+    return hashlib.sha256(f"{object_id}\0{prefix}\0{fmt}".encode()).hexdigest()
+
+def git_archive(repo_path, fmt, prefix, treeish):
+    """
+    Streams the output of git archive.
+    """
+    args = [
+        "git",
+        "--git-dir", repo_path,
+        "archive",
+        "--format", fmt,
+        "--prefix", prefix,
+        "--",
+        treeish,
+    ]
+    subp = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=sys.stderr)
+    try:
+        while True:
+            chunk = subp.stdout.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        subp.stdout.close()
+        if subp.poll() is None:
+            subp.kill()
+        subp.wait()
+    # Never let a failed archive be cached
+    if subp.returncode != 0:
+        raise subprocess.CalledProcessError(subp.returncode, args)
+
+class ChunkReader(io.RawIOBase):
+    """
+    A file over an iterable of byte strings, which is closed along with it.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            self._pending = next(self._chunks, b"")
+            if not self._pending:
+                return 0
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed and hasattr(self._chunks, "close"):
+            self._chunks.close()
+        super().close()
+
+ARCHIVE_FORMATS = {
+    "tar.gz": "application/tar+gzip",
+    "tar": "application/x-tar",
+    "tar.zst": "application/zstd",
+    "zip": "application/zip",
+}
+
+def archive_formats():
+    """
+    Returns the archive formats which can be built on this instance.
+    """
+    return [fmt for fmt in ARCHIVE_FORMATS
+            if fmt != "tar.zst" or zstandard is not None]
+
+_archive_threads = int(cfg("git.sr.ht", "archive-threads",
+    default=str(os.cpu_count() or 1)))
+_use_parallel_gzip = cfg("git.sr.ht", "archive-parallel-gzip",
+    default="no") == "yes"
+_compressors = ThreadPoolExecutor(_archive_threads)
+
+def _walk(git_repo, tree, path):
+    # Yields the entries of tree in the order git archive writes them:
+    # each directory, followed by its contents
+    for entry in tree:
+        entry_path = path + entry.raw_name
+        if entry.filemode == pygit2.GIT_FILEMODE_TREE:
+            yield entry_path + b"/", entry
+            yield from _walk(git_repo, git_repo.get(entry.id), entry_path + b"/")
+        elif entry.filemode == pygit2.GIT_FILEMODE_COMMIT:
+            # Submodules are archived as empty directories
+            yield entry_path + b"/", entry
+        else:
+            yield entry_path, entry
+
+# Whether each tree has a .gitattributes anywhere below it, by tree ID
+_attribute_trees = LRUCache(65536)
+
+def _has_attributes(git_repo, tree):
+    has = _attribute_trees.get(tree.id)
+    if has is not None:
+        return has
+    has = False
+    for entry in tree:
+        if entry.filemode == pygit2.GIT_FILEMODE_TREE:
+            has = _has_attributes(git_repo, git_repo.get(entry.id))
+        else:
+            has = entry.name == ".gitattributes"
+        if has:
+            break
+    _attribute_trees.set(tree.id, has)
+    return has
+
+def _uses_attributes(git_repo, tree):
+    # git archive applies export-ignore, export-subst, eol conversion and
+    # other attributes, which are left to git itself
+    if os.path.exists(os.path.join(git_repo.path, "info", "attributes")):
+        return True
+    key = f"git.sr.ht:archive-attributes:{tree.id}:v1"
+    cached = get_cache(key)
+    if cached:
+        return json.loads(cached)
+    # Subtrees are remembered too, so that the next commit only walks the
+    # directories it changed
+    has = _has_attributes(git_repo, tree)
+    set_cache(key, timedelta(days=7), json.dumps(has))
+    return has
+
+_tar_block = 512
+_tar_record = 20 * _tar_block
+_tar_umask = 0o002
+_ustar_max = 0o77777777777
+
+def _pax_record(keyword, value):
+    # "%u %s=%s\n", where the length counts its own digits
+    length = 1 + 1 + len(keyword) + 1 + len(value) + 1
+    digits = 1
+    while length // 10 >= digits:
+        length += 1
+        digits *= 10
+    return b"%d %s=%s\n" % (length, keyword, value)
+
+def _tar_header(name, mode, size, mtime, typeflag,
+        linkname=b"", prefix=b""):
+    header = bytearray(_tar_block)
+    header[0:len(name)] = name
+    header[100:108] = b"%07o\0" % (mode & 0o7777)
+    header[108:116] = b"%07o\0" % 0
+    header[116:124] = b"%07o\0" % 0
+    header[124:136] = b"%011o\0" % (size if stat.S_ISREG(mode) else 0)
+    header[136:148] = b"%011o\0" % mtime
+    header[156:157] = typeflag
+    header[157:157 + len(linkname)] = linkname
+    header[257:263] = b"ustar\0"
+    header[263:265] = b"00"
+    header[265:269] = b"root"
+    header[297:301] = b"root"
+    header[329:337] = b"%07o\0" % 0
+    header[337:345] = b"%07o\0" % 0
+    header[345:345 + len(prefix)] = prefix
+    header[148:156] = b"%07o\0" % (sum(header) + 8 * ord(" "))
+    return bytes(header)
+
+def _path_prefix_len(path, maxlen):
+    i = len(path)
+    if i > 1 and path[i - 1:i] == b"/":
+        i -= 1
+    i = min(i, maxlen)
+    i -= 1
+    while i > 0 and path[i:i + 1] != b"/":
+        i -= 1
+    return i
+
+def _tar_member(path, oid, mode, mtime, data=b""):
+    # Returns the chunks of a tar member, laid out like git archive does
+    if stat.S_ISDIR(mode) or stat.S_IFMT(mode) == pygit2.GIT_FILEMODE_COMMIT:
+        typeflag = b"5"
+        mode = (mode | 0o777) & ~_tar_umask
+    elif stat.S_ISLNK(mode):
+        typeflag = b"2"
+        mode |= 0o777
+    else:
+        typeflag = b"0"
+        mode = (mode | (0o777 if mode & 0o100 else 0o666)) & ~_tar_umask
+
+    ext = b""
+    name, prefix = path, b""
+    if len(path) > 100:
+        plen = _path_prefix_len(path, 155)
+        rest = len(path) - plen - 1
+        if plen > 0 and rest <= 100:
+            name, prefix = path[plen + 1:], path[:plen]
+        else:
+            name = b"%s.data" % oid.encode()
+            ext += _pax_record(b"path", path)
+
+    linkname = b""
+    if stat.S_ISLNK(mode):
+        if len(data) > 100:
+            linkname = b"see %s.paxheader" % oid.encode()
+            ext += _pax_record(b"linkpath", bytes(data))
+        else:
+            linkname = bytes(data)
+
+    size = len(data)
+    if stat.S_ISREG(mode) and size > _ustar_max:
+        ext += _pax_record(b"size", b"%d" % size)
+        size = 0
+
+    chunks = []
+    if ext:
+        chunks.append(_tar_header(b"%s.paxheader" % oid.encode(),
+            0o100666, len(ext), mtime, b"x"))
+        chunks.append(_tar_pad(ext))
+    chunks.append(_tar_header(name, mode, size, mtime, typeflag,
+        linkname=linkname, prefix=prefix))
+    if stat.S_ISREG(mode) and data:
+        chunks.append(data)
+        if len(data) % _tar_block:
+            chunks.append(bytes(_tar_block - len(data) % _tar_block))
+    return chunks
+
+def _tar_pad(data):
+    if len(data) % _tar_block:
+        data += bytes(_tar_block - len(data) % _tar_block)
+    return data
+
+def _tar(git_repo, tree, prefix, mtime, commit_id=None):
+    """
+    Streams a tar archive of tree, identical to the output of git archive
+    for trees without attributes.
+    """
+    offset = 0
+    if commit_id is not None:
+        ext = _pax_record(b"comment", commit_id.encode())
+        for chunk in (_tar_header(b"pax_global_header", 0o100666,
+                len(ext), mtime, b"g"), _tar_pad(ext)):
+            offset += len(chunk)
+            yield chunk
+
+    if prefix:
+        for chunk in _tar_member(prefix.encode(), str(tree.id), 0o40777,
+                mtime):
+            offset += len(chunk)
+            yield chunk
+
+    for path, entry in _walk(git_repo, tree, prefix.encode()):
+        data = b""
+        if entry.filemode in (pygit2.GIT_FILEMODE_BLOB,
+                pygit2.GIT_FILEMODE_BLOB_EXECUTABLE,
+                pygit2.GIT_FILEMODE_LINK):
+            data = memoryview(git_repo.get(entry.id))
+        for chunk in _tar_member(path, str(entry.id), entry.filemode,
+                mtime, data):
+            offset += len(chunk)
+            yield chunk
+
+    # Pad the archive to whole records, with at least two empty blocks
+    tail = _tar_record - offset % _tar_record
+    if tail < 2 * _tar_block:
+        tail += _tar_record
+    yield bytes(tail)
+
+_gzip_header = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03"
+_gzip_block = 128 * 1024
+_gzip_window = 32 * 1024
+
+def _gzip(chunks):
+    # Compressed like git archive does, so that the archive is identical
+    compress = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compress.compress(chunk)
+        if data:
+            yield data
+    yield compress.flush()
+
+def _deflate_block(block, window, last):
+    compress = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+            -zlib.MAX_WBITS, zdict=window) if window else zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compress.compress(block)
+    return data + compress.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def _parallel_gzip(chunks):
+    # Like pigz: blocks are deflated independently in the thread pool,
+    # each primed with the end of the previous one, and concatenated into
+    # a single gzip stream
+    yield _gzip_header
+    crc, size = 0, 0
+    pending = deque()
+    window = b""
+    buf = bytearray()
+
+    def submit(block, last):
+        nonlocal crc, size, window
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+        pending.append(_compressors.submit(_deflate_block, block, window, last))
+        window = block[-_gzip_window:]
+
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= _gzip_block:
+            submit(bytes(buf[:_gzip_block]), False)
+            del buf[:_gzip_block]
+        while pending and (pending[0].done()
+                or len(pending) > 2 * _archive_threads):
+            yield pending.popleft().result()
+    submit(bytes(buf), True)
+    while pending:
+        yield pending.popleft().result()
+    yield struct.pack("<II", crc, size & 0xffffffff)
+
+def _zstd(chunks):
+    compress = zstandard.ZstdCompressor(
+            threads=_archive_threads).compressobj()
+    for chunk in chunks:
+        data = compress.compress(chunk)
+        if data:
+            yield data
+    yield compress.flush()
+
+class _ChunkWriter(io.RawIOBase):
+    # Collects what zipfile writes, to be streamed out as it goes
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+def _zip(git_repo, tree, prefix, mtime):
+    # Zip timestamps are local times, and cannot predate 1980
+    date_time = time.gmtime(max(mtime, 315532800))[:6]
+    out = _ChunkWriter()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        members = [(prefix.encode(), None)]
+        members += _walk(git_repo, tree, prefix.encode())
+        for path, entry in members:
+            info = zipfile.ZipInfo(path.decode("utf-8", "replace"), date_time)
+            info.create_system = 3
+            mode = entry.filemode if entry else 0o40775
+            if stat.S_ISDIR(mode) or mode == pygit2.GIT_FILEMODE_COMMIT:
+                info.external_attr = (0o40775 << 16) | 0x10
+                zf.writestr(info, b"")
+                yield from out.drain()
+                continue
+
+            data = memoryview(git_repo.get(entry.id))
+            info.file_size = len(data)
+            if stat.S_ISLNK(mode):
+                info.external_attr = 0o120777 << 16
+            else:
+                info.external_attr = (mode & 0o777 | stat.S_IFREG) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with zf.open(info, "w") as dest:
+                for i in range(0, len(data), _gzip_block):
+                    dest.write(data[i:i + _gzip_block])
+                    yield from out.drain()
+            yield from out.drain()
+    yield from out.drain()
+
+def build_archive(git_repo, tree, prefix, fmt, mtime, commit_id=None):
+    """
+    Streams an archive of tree in one of ARCHIVE_FORMATS, whose entries are
+    read directly from the object database.
+
+    Tar archives are laid out exactly like git archive lays them out,
+    including the commit ID if given, and gzip compressed the same way, so
+    that checksums and signatures of archives served before still match.
+    If archive-parallel-gzip is enabled, they are instead compressed on
+    archive-threads threads, which is faster for large trees but produces
+    different bytes. zstd archives are always compressed in parallel.
+
+    Trees with gitattributes, which may change the archive, are archived
+    by git itself. When archiving a tree without a commit, git timestamps
+    the entries with the current time rather than mtime.
+    """
+    if _uses_attributes(git_repo, tree):
+        treeish = commit_id or str(tree.id)
+        if fmt == "zip":
+            return git_archive(git_repo.path, "zip", prefix, treeish)
+        tar = git_archive(git_repo.path, "tar", prefix, treeish)
+    elif fmt == "zip":
+        return _zip(git_repo, tree, prefix, mtime)
+    else:
+        tar = _tar(git_repo, tree, prefix, mtime, commit_id)
+
+    if fmt == "tar.gz":
+        return _parallel_gzip(tar) if _use_parallel_gzip else _gzip(tar)
+    if fmt == "tar.zst":
+        return _zstd(tar)
+    return tar
+
+def _touch(path):
+    # Cached archives are evicted by mtime, which is bumped on each use
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _evict():
+    archives = []
+    total = 0
+    now = time.time()
+    for entry in os.scandir(_archive_dir):
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.name.endswith(".lock"):
+            if st.st_mtime < now - _stale_build:
+                _unlink_lock(entry.path)
+            continue
+        if entry.name.startswith("."):
+            if st.st_mtime < now - _stale_build:
+                _unlink(entry.path)
+            continue
+        archives.append((st.st_mtime, st.st_size, entry.path))
+        total += st.st_size
+
+    archives.sort()
+    for _, size, path in archives:
+        if total <= _archive_size:
+            break
+        _unlink(path)
+        _unlink_lock(path + ".lock")
+        total -= size
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def _unlink_lock(path):
+    # Lock files left behind by failed or aborted builds are only removed
+    # while nobody holds them
+    try:
+        lock = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        _unlink(path)
+
+class _Build:
+    # An archive being written to a temporary file by a background thread
+    def __init__(self, path, lock):
+        self.path = path
+        self.tmp = tempfile.NamedTemporaryFile(dir=_archive_dir, prefix=".",
+                delete=False)
+        self.done = False
+        self.error = None
+        self._lock = lock
+        self._cond = threading.Condition()
+
+    def run(self, build):
+        try:
+            for chunk in build():
+                self.tmp.write(chunk)
+                self.tmp.flush()
+                with self._cond:
+                    self._cond.notify_all()
+            self.tmp.close()
+            os.rename(self.tmp.name, self.path)
+        except BaseException as ex:
+            self.error = ex
+        finally:
+            self.tmp.close()
+            _unlink(self.tmp.name)
+            # Releases the lock, letting waiting requests serve the new file
+            self._lock.close()
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+        _evict()
+
+    def wait(self):
+        with self._cond:
+            if not self.done:
+                self._cond.wait(timeout=1)
+            return self.done
+
+class _BuildReader(io.RawIOBase):
+    """
+    A file over an archive being built, which follows the temporary file
+    as it grows.
+    """
+    def __init__(self, build):
+        self._build = build
+        self._file = open(build.tmp.name, "rb", buffering=0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            n = self._file.readinto(b)
+            if n:
+                return n
+            done = self._build.done
+            if done:
+                # Catch up on anything written before the build finished
+                n = self._file.readinto(b)
+                if n:
+                    return n
+                if self._build.error is not None:
+                    raise self._build.error
+                return 0
+            self._build.wait()
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+def _wait_for_lock(lock):
+    deadline = time.monotonic() + _lock_timeout
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+
+def get_archive(key, build):
+    """
+    Returns (path, None) if the archive cached under key exists, or
+    (None, file) with a file over the archive streamed by build().
+
+    Archives are stored in the archive-cache directory, shared by every
+    worker. Only one worker builds a given archive at a time, on a
+    background thread which writes it to the cache as fast as it can, while
+    the file returned follows it. build() is called on that thread, and
+    must not use repository handles of the calling thread. Requests for an
+    archive which is being built wait up to archive-lock-timeout seconds
+    for it to be done, then give up and build it without caching it. The
+    least recently used archives are evicted to keep the directory under
+    archive-cache-size bytes.
+    """
+    if not _archive_dir:
+        return None, ChunkReader(build())
+
+    path = os.path.join(_archive_dir, key)
+    if _touch(path):
+        return path, None
+
+    os.makedirs(_archive_dir, exist_ok=True)
+    lock = open(path + ".lock", "wb")
+    try:
+        if not _wait_for_lock(lock):
+            lock.close()
+            return None, ChunkReader(build())
+        if _touch(path):
+            lock.close()
+            return path, None
+        pending = _Build(path, lock)
+        reader = _BuildReader(pending)
+    except:
+        lock.close()
+        raise
+    threading.Thread(target=pending.run, args=(build,), daemon=True).start()
+    return None, reader
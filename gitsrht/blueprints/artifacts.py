@@ -2,7 +2,7 @@ import requests
 from flask import Blueprint, redirect, render_template, request
 from flask import send_file, abort, url_for
 from gitsrht.access import check_access, UserAccess
-from gitsrht.git import Repository as GitRepository, strip_pgp_signature
+from gitsrht.git import open_repository, strip_pgp_signature
 from gitsrht.graphql import Client, Upload, GraphQLClientGraphQLMultiError
 from srht.crypto import encrypt_request_authorization
 from srht.graphql import InternalAuth, Error, has_error
@@ -16,7 +16,7 @@ artifacts = Blueprint('artifacts', __name__)
 def ref_upload(owner, repo, ref):
     client = Client()
     owner, repo = check_access(owner, repo, UserAccess.manage)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         valid = Validation(request)
         valid.expect(request.files.get("file"), "File is required", field="file")
         file_list = request.files.getlist("file")
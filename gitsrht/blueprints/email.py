@@ -11,7 +11,7 @@ from email.message import EmailMessage
 from flask import Blueprint, render_template, abort, request, url_for, session
 from flask import redirect
 from gitsrht.access import get_repo_or_redir
-from gitsrht.git import Repository as GitRepository, commit_time, diffstat
+from gitsrht.git import open_repository, commit_time, diffstat
 from gitsrht.git import get_log
 from markupsafe import Markup
 from srht.config import cfg, cfgi, cfgb
@@ -52,7 +52,7 @@ def render_send_email_start(owner, repo, git_repo, selected_branch,
 @loginrequired
 def send_email_start(owner, repo):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         ncommits = int(request.args.get("commits", default=8))
         if ncommits > 32:
             ncommits = 32
@@ -67,7 +67,7 @@ def send_email_start(owner, repo):
 @loginrequired
 def send_email_end(owner, repo):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         valid = Validation(request)
         branch = valid.require("branch")
         if not branch in git_repo.branches:
@@ -241,7 +241,7 @@ def prepare_patchset(repo, git_repo, cover_letter=None, extra_headers=False,
 @loginrequired
 def send_email_review(owner, repo):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         valid = Validation(request)
         start_commit = valid.require("start_commit")
         end_commit = valid.require("end_commit")
@@ -313,7 +313,7 @@ def send_email_review(owner, repo):
 @loginrequired
 def send_email_send(owner, repo):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         valid = Validation(request)
         start_commit = valid.require("start_commit")
         end_commit = valid.require("end_commit")
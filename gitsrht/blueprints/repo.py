@@ -1,36 +1,45 @@
 import binascii
+import itertools
 import json
 import mimetypes
 import os
 import pygit2
 import pygments
-import subprocess
 import sys
 from datetime import datetime, timedelta
 from flask import Blueprint, render_template, abort, current_app, send_file, make_response, request
 from flask import Response, url_for, session, redirect
+from gitsrht.archive import ARCHIVE_FORMATS, archive_formats, archive_key
+from gitsrht.archive import build_archive, get_archive
+from gitsrht.cache import LRUCache, get_render_cache, set_render_cache
 from gitsrht.editorconfig import EditorConfig
-from gitsrht.formatting import get_formatted_readme, get_highlighted_file
-from gitsrht.git import Repository as GitRepository, commit_time, annotate_tree
+from gitsrht.formatting import get_formatted_markdown, get_formatted_readme
+from gitsrht.formatting import get_highlighted_file, get_highlighted_window
+from gitsrht.formatting import get_highlighted_lines, split_lines
+from gitsrht.git import open_repository, annotate_tree, get_mailmap, BlobReader
+from gitsrht.git import LargeBlob, get_blame, read_blob
 from gitsrht.git import diffstat, get_log, diff_for_commit, strip_pgp_signature
 from gitsrht.graphql import Client, GraphQLClientGraphQLMultiError
+from gitsrht.patch import PatchTooLarge, format_patch, patch_diff
+from gitsrht.refs import ref_decorations, signature_notes, tag_index
 from gitsrht.rss import generate_refs_feed, generate_commits_feed
 from gitsrht.spdx import SPDX_LICENSES
 from gitsrht.types import Artifact, User
 from gitsrht.urls import clone_urls
-from io import BytesIO
+from io import BufferedReader, BytesIO
 from markupsafe import Markup, escape
 from jinja2.utils import url_quote
 from gitsrht.access import get_repo, get_repo_or_redir
+from srht.cache import get_cache, set_cache
 from srht.config import cfg, get_origin
 from srht.graphql import has_error
-from srht.markdown import markdown, sanitize
+from srht.markdown import sanitize
 from srht.oauth import loginrequired
 from urllib.parse import urlparse
 
 repo = Blueprint('repo', __name__)
 
-def get_license_info_for_tip(tip):
+def _get_license_info(tree):
         license_exists = False
         licences_names = ["LICENSES", "licenses", "LICENCES", "licences"]
         for path in [
@@ -45,14 +54,14 @@ def get_license_info_for_tip(tip):
                 "COPYRIGHT.md", "copyright.md",
                 "COPYRIGHT", "copyright",
         ] + licences_names:
-            if path in tip.tree:
+            if path in tree:
                 license_exists = True
                 break
 
         licenses = []
         for lic in licences_names:
-            if lic in tip.tree and isinstance(tip.tree[lic], pygit2.Tree):
-                for o in tip.tree[lic]:
+            if lic in tree and isinstance(tree[lic], pygit2.Tree):
+                for o in tree[lic]:
                     license_id = o.name
                     if license_id not in SPDX_LICENSES:
                         license_id = os.path.splitext(o.name)[0]
@@ -65,6 +74,26 @@ def get_license_info_for_tip(tip):
 
         return license_exists, licenses
 
+_license_info = LRUCache(1024)
+
+def get_license_info_for_tip(tip):
+    # License detection only depends on the root tree, so it is cached by
+    # tree ID in-process and in the shared cache
+    tree_id = str(tip.tree_id)
+    info = _license_info.get(tree_id)
+    if info is not None:
+        return info
+
+    cache_key = f"git.sr.ht:license:{tree_id}:v1"
+    cached = get_cache(cache_key)
+    if cached:
+        info = tuple(json.loads(cached))
+    else:
+        info = _get_license_info(tip.tree)
+        set_cache(cache_key, timedelta(days=30), json.dumps(info))
+    _license_info.set(tree_id, info)
+    return info
+
 def get_readme(repo, git_repo, tip, link_prefix=None):
     if repo.readme is not None:
         return Markup(sanitize(repo.readme))
@@ -101,6 +130,37 @@ def _highlight_file(repo, ref, entry, data, blob_id, commit_id):
     else:
         return get_highlighted_file(entry.name, blob_id, data)
 
+_highlight_window = int(cfg("git.sr.ht", "highlight-window", default="2000"))
+
+class CodeWindow:
+    def __init__(self, index, start, count, html=None):
+        self.index = index
+        self.start = start
+        self.count = count
+        self.html = html
+
+def _code_windows(entry, blob_id, data, selected=0):
+    """
+    Splits files longer than highlight-window lines into windows, of which
+    only the first and the selected one are highlighted. The others are
+    fetched by the browser as they are needed. Returns None for shorter
+    files, and symlinks.
+    """
+    if entry.filemode == pygit2.GIT_FILEMODE_LINK:
+        return None
+    lines = split_lines(data)
+    if len(lines) <= _highlight_window:
+        return None
+    windows = []
+    for index, start in enumerate(range(0, len(lines), _highlight_window)):
+        html = None
+        if index in (0, selected):
+            html = get_highlighted_window(entry.name, blob_id,
+                    lines, index, _highlight_window)
+        windows.append(CodeWindow(index, start + 1,
+            min(_highlight_window, len(lines) - start), html))
+    return windows
+
 def linecounter(count, start=1, url="", selected=None):
     out = []
     for i in range(start, count + start):
@@ -128,10 +188,10 @@ def get_last_3_commits(git_repo, commit):
 def summary(owner, repo):
     owner, repo = get_repo_or_redir(owner, repo)
 
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         if git_repo.is_empty:
             return render_empty_repo(owner, repo, "summary")
-        mailmap = pygit2.Mailmap.from_repository(git_repo)
+        mailmap = get_mailmap(git_repo)
 
         default_branch = git_repo.default_branch()
         default_branch_name = default_branch.raw_name \
@@ -146,14 +206,12 @@ def summary(owner, repo):
             ref=f"{default_branch_name}/", path="")  # Trailing slash needed
         readme = get_readme(repo, git_repo, tip,
             link_prefix=[link_prefix, blob_prefix])
-        tags = [(ref, git_repo.get(git_repo.references[ref.decode('utf-8')].raw_target))
-            for ref in git_repo.raw_listall_references()
-            if ref.startswith(b"refs/tags/")]
-        tags = [tag for tag in tags
-                if (isinstance(tag[1], pygit2.Tag) or isinstance(tag[1], pygit2.Commit))
-                and (isinstance(tag[1], pygit2.Commit) or isinstance(tag[1].get_object(), pygit2.Commit))]
-        tags = sorted(tags, key=lambda c: commit_time(c[1]), reverse=True)
-        latest_tag = tags[0] if len(tags) else None
+        tags = [info for info in tag_index(git_repo)
+                if info.type == "commit"
+                or (info.type == "tag" and info.object_type == "commit")]
+        latest_tag = max(tags, key=lambda info: info.author_time, default=None)
+        if latest_tag:
+            latest_tag = (latest_tag.raw_name, git_repo.get(latest_tag.target))
 
         message = session.pop("message", None)
 
@@ -229,12 +287,12 @@ def lookup_signature(git_repo, ref, fmt=['tar', 'tar.gz']):
         return None, None
 
     for trial in fmt:
-        try:
-            note = git_repo.lookup_note(str(commit_or_tag.id), f'refs/notes/signatures/{trial}')
-        except KeyError:
+        note_id = signature_notes(git_repo, trial).get(str(commit_or_tag.id))
+        if note_id is None:
             continue
 
-        return note.message, trial
+        note = git_repo.get(note_id)
+        return note.data.decode("utf-8", "replace"), trial
     return None, None
 
 @repo.route("/<owner>/<repo>/tree", defaults={"ref": None, "path": ""})
@@ -246,7 +304,7 @@ def tree(owner, repo, ref, path):
     if ref and "/" in ref and not path:
         ref, _, path = ref.partition("/")
 
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         if git_repo.is_empty:
             return render_empty_repo(owner, repo, "tree")
 
@@ -275,17 +333,14 @@ def tree(owner, repo, ref, path):
             etype = (entry.type_str
                     if hasattr(entry, "type_str") else entry.type)
             if etype == "blob":
-                tree = annotate_tree(git_repo, tree, commit)
-                commit = next(
-                        (e.commit for e in tree if e.name == entry.name), None)
-                blob = git_repo.get(entry.id)
+                blob = read_blob(git_repo, entry.id)
                 data = None
-                if not blob.is_binary:
+                if not blob.is_binary and not isinstance(blob, LargeBlob):
                     try:
                         data = blob.data.decode()
                     except ValueError:
                         data = '[unable to decode]'
-                md = not blob.is_binary and entry.name.endswith(".md")
+                md = data is not None and entry.name.endswith(".md")
                 if md:
                     link_prefix = url_for('repo.tree', owner=repo.owner,
                             repo=repo.name, ref=refname,
@@ -293,22 +348,39 @@ def tree(owner, repo, ref, path):
                     blob_prefix = url_for(
                         'repo.raw_blob', owner=repo.owner, repo=repo.name,
                         ref=refname, path=os.path.dirname("/".join(path)))
-                    md = markdown(data,
+                    md = get_formatted_markdown(str(blob.id), data,
                             link_prefix=[link_prefix, blob_prefix])
                 force_source = "view-source" in request.args
 
+                windows = None
+                if data is not None:
+                    try:
+                        window = int(request.args.get("window", 0))
+                    except ValueError:
+                        abort(400)
+                    windows = _code_windows(entry, str(blob.id), data, window)
+                    if windows and not 0 <= window < len(windows):
+                        abort(404)
+                    if windows and "fragment" in request.args:
+                        return render_template("blob-window.html",
+                                window=windows[window],
+                                linecounter=linecounter,
+                                editorconfig=editorconfig)
+
                 return render_template("blob.html", view="blob",
                         owner=owner, repo=repo, ref=refname, path=path, entry=entry,
                         blob=blob, data=data, commit=orig_commit,
                         highlight_file=_highlight_file,
-                        linecounter=linecounter,
+                        linecounter=linecounter, windows=windows,
+                        window_size=_highlight_window,
                         editorconfig=editorconfig,
                         markdown=md, force_source=force_source, pygit2=pygit2)
             tree = git_repo.get(entry.id)
 
         if not tree or tree.type != pygit2.GIT_OBJECT_TREE:
             abort(404)
-        tree = annotate_tree(git_repo, tree, commit)
+        tree = annotate_tree(git_repo, tree, commit,
+                path="/".join(part for part in path if part))
         tree = sorted(tree, key=lambda e: e.name)
 
         default_branch = git_repo.default_branch()
@@ -319,12 +391,15 @@ def tree(owner, repo, ref, path):
                 ref=refname, commit=commit, entry=entry, tree=tree, path=path,
                 pygit2=pygit2, license_exists=license_exists, licenses=licenses)
 
-def resolve_blob(git_repo, ref, path):
+def resolve_entry(git_repo, ref, path):
+    """
+    Like resolve_blob, but returns the tree entry of the blob without
+    reading the blob itself.
+    """
     commit, ref, path = lookup_ref(git_repo, ref, path)
     if not isinstance(commit, pygit2.Commit):
         abort(404)
 
-    blob = None
     entry = None
     tree = commit.tree
     if not tree:
@@ -340,18 +415,16 @@ def resolve_blob(git_repo, ref, path):
         etype = (entry.type_str
                 if hasattr(entry, "type_str") else entry.type)
         if etype == "blob":
-            tree = annotate_tree(git_repo, tree, commit)
-            commit = next(e.commit for e in tree if e.name == entry.name)
-            blob = git_repo.get(entry.id)
-            break
+            return orig_commit, ref, path, entry
         tree = git_repo.get(entry.id)
         if not tree:
             abort(404)
 
-    if not blob:
-        abort(404)
+    abort(404)
 
-    return orig_commit, ref, path, blob, entry
+def resolve_blob(git_repo, ref, path):
+    orig_commit, ref, path, entry = resolve_entry(git_repo, ref, path)
+    return orig_commit, ref, path, read_blob(git_repo, entry.id), entry
 
 def resolve_mimetype(path, blob):
     filename = path[-1]
@@ -365,14 +438,26 @@ def resolve_mimetype(path, blob):
 @repo.route("/<owner>/<repo>/blob/<path:ref>/<path:path>")
 def raw_blob(owner, repo, ref, path):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
-        orig_commit, ref, path, blob, entry = resolve_blob(git_repo, ref, path)
-
-        response = send_file(BytesIO(blob.data),
+    with open_repository(repo.path) as git_repo:
+        orig_commit, ref, path, entry = resolve_entry(git_repo, ref, path)
+
+        # The blob ID validates the contents, so there is no need to read
+        # the blob to answer a conditional request
+        etag = str(entry.id)
+        if request.if_none_match.contains_weak(etag):
+            response = make_response("", 304)
+            response.set_etag(etag)
+            return response
+
+        blob = git_repo.get(entry.id)
+        response = send_file(BlobReader(blob),
                 as_attachment=blob.is_binary,
                 download_name=entry.name,
-                mimetype=resolve_mimetype(path, blob))
-        response = make_response(response)
+                mimetype=resolve_mimetype(path, blob),
+                etag=etag, conditional=False)
+        response.content_length = blob.size
+        response = response.make_conditional(request,
+                accept_ranges=True, complete_length=blob.size)
         # Do not allow any other resources, including scripts, to be loaded from this resourse
         # This prevents XSS attacks in SVG files!
         response.headers['Content-Security-Policy'] = "upgrade-insecure-requests; sandbox; frame-src 'none'; media-src 'none'; script-src 'none'; object-src 'none'; worker-src 'none';"
@@ -387,92 +472,205 @@ def lookup_user():
     cache = {}
     return lambda email: _lookup_user(email, cache)
 
-# We only care about these fields in in blame.html, so we discard
-# boundary, final_start_line_number, orig_commit_id, orig_committer,
-# orig_path, and orig_start_line_number here
-class FakeBlameHunk:
-    def __init__(self, hunk):
-        self.final_commit_id = hunk.final_commit_id
-        self.final_committer = hunk.final_committer
-        self.lines_in_hunk = hunk.lines_in_hunk
-
-# Blame hunks of the same final commit are split if they're not consecutive
-# lines in the original commit (cf. https://todo.sr.ht/~sircmpwn/git.sr.ht/357)
-def weld_hunks(blame):
-    last = None
-    for nxt in map(FakeBlameHunk, blame):
-        if last is None:
-            last = nxt
-            continue
-        if last.final_commit_id == nxt.final_commit_id:
-            last.lines_in_hunk += nxt.lines_in_hunk
-        else:
-            yield last
-            last = nxt
-    if last is not None:
-        yield last
+_blame_margin = int(cfg("git.sr.ht", "blame-margin", default="250"))
+
+def _blame_range(selected, line_count, margin=True):
+    """
+    Parses the range of lines to blame, given as "first-last" or as a single
+    line, and widens it by blame-margin lines on each side if margin is set.
+    Files too long to blame whole start with their first lines.
+    """
+    first, _, last = (selected or "1").partition("-")
+    try:
+        first = int(first)
+        last = int(last) if last else first
+    except ValueError:
+        abort(400)
+    if not 1 <= first <= last or first > line_count:
+        abort(404)
+    if margin:
+        first = max(1, first - _blame_margin)
+        last += _blame_margin
+    return first, min(last, line_count)
+
+_max_blame_size = int(cfg("git.sr.ht", "max-blame-size",
+    default=str(64 << 20)))
+
+def _blob_windows(blob, first, last, size):
+    """
+    Reads the windows of size lines of a blob from first to last, and the
+    first one, which the lexer is guessed from, without decoding or copying
+    the rest of it. Returns the number of lines of the blob, counted like
+    split_lines counts them, and a dict of the lines of each window read.
+    """
+    reader = BufferedReader(BlobReader(blob))
+    windows = dict()
+    line_count = 0
+    for index in range(last + 1):
+        window = list(itertools.islice(reader, size))
+        line_count += len(window)
+        if index == 0 or index >= first:
+            windows[index] = [line.decode() if line.endswith(b"\n")
+                    else line.decode() + "\n" for line in window]
+        if len(window) < size:
+            return line_count, windows
+    # The remaining lines are only counted
+    end = b"\n"
+    while chunk := reader.read(1 << 20):
+        line_count += chunk.count(b"\n")
+        end = chunk[-1:]
+    if end != b"\n":
+        line_count += 1
+    return line_count, windows
 
 @repo.route("/<owner>/<repo>/blame/<path:ref>", defaults={"path": ""})
 @repo.route("/<owner>/<repo>/blame/<path:ref>/<path:path>")
 @loginrequired
 def blame(owner, repo, ref, path):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         orig_commit, ref, path, blob, entry = resolve_blob(git_repo, ref, path)
         refname = ref.decode('utf-8', 'replace')
+        if isinstance(blob, LargeBlob):
+            if blob.size > _max_blame_size:
+                return redirect(url_for("repo.tree",
+                    owner=repo.owner.canonical_name, repo=repo.name,
+                    ref=refname, path="/".join(path)))
+            # Too large to show whole, but it is blamed a range at a time
+            blob = git_repo.get(blob.id)
+            large = True
+        else:
+            large = False
         if blob.is_binary:
             return redirect(url_for("repo.log",
                 owner=repo.owner.canonical_name, repo=repo.name, ref=refname,
                 path="/".join(path)))
+
+        selected = request.args.get("lines")
+        fragment = request.args.get("fragment")
         try:
-            data = blob.data.decode()
+            if large:
+                # Only the windows around the range are read and decoded
+                first, last = _blame_range(selected, sys.maxsize,
+                        margin=fragment is None)
+                line_count, windows = _blob_windows(blob,
+                        (first - 1) // _highlight_window,
+                        (last - 1) // _highlight_window, _highlight_window)
+                window = windows.get
+            else:
+                data = blob.data.decode()
+                lines = split_lines(data)
+                line_count = len(lines)
+                window = lambda index: lines[index * _highlight_window:
+                        (index + 1) * _highlight_window]
         except ValueError:
             return redirect(url_for("repo.log",
                 owner=repo.owner.canonical_name, repo=repo.name, ref=refname,
                 path="/".join(path)))
 
+        ranged = large or selected is not None or line_count > _highlight_window
+        if ranged:
+            first, last = _blame_range(selected, line_count,
+                    margin=fragment is None)
+            lines_range = (first, last)
+        else:
+            first, last = 1, line_count
+            lines_range = None
+
         try:
-            blame = git_repo.blame("/".join(path), newest_commit=orig_commit.id)
+            blame = get_blame(git_repo, orig_commit, "/".join(path),
+                    lines_range, line_count)
         except KeyError as ke:  # Path not in the tree
             abort(404)
         except ValueError:
             # ValueError: object at path 'hubsrht/' is not of the asked-for type 3
             abort(400)
 
-        return render_template("blame.html", view="blame", owner=owner,
-                repo=repo, ref=refname, path=path, entry=entry, blob=blob, data=data,
-                blame=list(weld_hunks(blame)), commit=orig_commit, highlight_file=_highlight_file,
+        before = after = None
+        if ranged:
+            code = get_highlighted_lines(entry.name, str(blob.id), window,
+                    first - 1, last - first + 1, _highlight_window)
+            # Fragments extend the blame in one direction only
+            if first > 1 and fragment != "after":
+                before = (max(1, first - _blame_margin), first - 1)
+            if last < line_count and fragment != "before":
+                after = (last + 1, min(line_count, last + _blame_margin))
+        else:
+            code = _highlight_file(repo, refname, entry, data,
+                    str(blob.id), str(orig_commit.id))
+
+        template = "blame.html" if fragment is None else "blame-range.html"
+        return render_template(template, view="blame", owner=owner,
+                repo=repo, ref=refname, path=path, entry=entry, blob=blob,
+                blame=blame, commit=orig_commit, code=code,
+                first=first, last=last, line_count=line_count,
+                ranged=ranged, before=before, after=after,
                 editorconfig=EditorConfig(git_repo, orig_commit.tree, path),
                 lookup_user=lookup_user(), pygit2=pygit2)
 
 @repo.route("/<owner>/<repo>/archive/<path:ref>.tar.gz", defaults = {"fmt": "tar.gz"})
-@repo.route("/<owner>/<repo>/archive/<path:ref>.<any('tar.gz','tar'):fmt>")
+@repo.route("/<owner>/<repo>/archive/<path:ref>.<any('tar.gz','tar','tar.zst','zip'):fmt>")
 def archive(owner, repo, ref, fmt):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
-        commit, ref, _ = lookup_ref(git_repo, ref, None)
+    if fmt not in archive_formats():
+        abort(404)
+    with open_repository(repo.path) as git_repo:
+        path = ""
+        try:
+            git_repo.revparse_single(ref)
+        except (KeyError, ValueError):
+            # A ref followed by the path of a subdirectory to archive
+            ref, _, path = ref.partition("/")
+        commit, ref, path = lookup_ref(git_repo, ref, path)
         if not isinstance(commit, pygit2.Commit):
             abort(404)
 
         refname = ref.decode('utf-8', 'replace')
-        args = [
-            "git",
-            "--git-dir", repo.path,
-            "archive",
-            "--format", fmt,
-            "--prefix", f"{repo.name}-{refname}/",
-            "--",
-            ref
-        ]
-        subp = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=sys.stderr)
-
-        return send_file(subp.stdout, mimetype="application/tar+gzip",
-                as_attachment=True, download_name=f"{repo.name}-{refname}.{fmt}")
+        path = path.strip("/")
+        if path:
+            try:
+                entry = commit.tree[path]
+            except KeyError:
+                abort(404)
+            if entry.filemode != pygit2.GIT_FILEMODE_TREE:
+                abort(404)
+            tree = git_repo.get(entry.id)
+            prefix = f"{repo.name}-{refname}/{path}/"
+            download_name = f"{repo.name}-{refname}-{path.replace('/', '-')}.{fmt}"
+            # Subdirectory archives record neither the commit nor its time,
+            # so they are shared by every commit with the same subtree
+            key = archive_key(str(tree.id), prefix, fmt)
+            mtime, commit_id = 0, None
+        else:
+            tree = commit.tree
+            prefix = f"{repo.name}-{refname}/"
+            download_name = f"{repo.name}-{refname}.{fmt}"
+            # Like git archive, archives embed the commit ID and time, so
+            # they are cached by commit rather than by tree
+            key = archive_key(str(commit.id), prefix, fmt)
+            mtime, commit_id = commit.commit_time, str(commit.id)
+
+        if request.if_none_match.contains_weak(key):
+            response = make_response("", 304)
+            response.set_etag(key)
+            return response
+
+        tree_id = tree.id
+        def build():
+            # Archives may be built on another thread, with its own handle
+            with open_repository(repo.path) as git_repo:
+                yield from build_archive(git_repo, git_repo.get(tree_id),
+                        prefix, fmt, mtime, commit_id)
+
+        cached, stream = get_archive(key, build)
+        return send_file(cached or stream, mimetype=ARCHIVE_FORMATS[fmt],
+                as_attachment=True, download_name=download_name,
+                etag=key, conditional=True)
 
 @repo.route("/<owner>/<repo>/archive/<path:ref>.<any('tar.gz','tar'):fmt>.asc")
 def archivesig(owner, repo, ref, fmt):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         sigdata, _ = lookup_signature(git_repo, ref, [fmt])
         if sigdata is None:
             abort(404)
@@ -500,27 +698,35 @@ class _AnnotatedRef:
         else:
             self.type = None
 
+class _CommitRefs:
+    """
+    Maps commit IDs to their _AnnotatedRefs, which are only loaded for the
+    commits which are actually looked up.
+    """
+    def __init__(self, git_repo):
+        self.git_repo = git_repo
+        self.decorations = ref_decorations(git_repo)
+
+    def __contains__(self, commit_id):
+        return commit_id in self.decorations
+
+    def __getitem__(self, commit_id):
+        return [_AnnotatedRef(self.git_repo, self.git_repo.references[name])
+                for name in self.decorations[commit_id]]
+
 def collect_refs(git_repo):
-    refs = {}
-    for _ref in git_repo.raw_listall_references():
-        _ref = _AnnotatedRef(git_repo, git_repo.references[_ref.decode('utf-8', 'replace')])
-        if not _ref.type or not hasattr(_ref, "commit"):
-            continue
-        if str(_ref.commit.id) not in refs:
-            refs[str(_ref.commit.id)] = []
-        refs[str(_ref.commit.id)].append(_ref)
-    return refs
+    return _CommitRefs(git_repo)
 
 @repo.route("/<owner>/<repo>/log", defaults={"ref": None, "path": ""})
 @repo.route("/<owner>/<repo>/log/<path:ref>", defaults={"path": ""})
 @repo.route("/<owner>/<repo>/log/<path:ref>/item/<path:path>")
 def log(owner, repo, ref, path):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         if git_repo.is_empty:
             return render_empty_repo(owner, repo, "log")
 
-        mailmap = pygit2.Mailmap.from_repository(git_repo)
+        mailmap = get_mailmap(git_repo)
 
         commit, ref, path = lookup_ref(git_repo, ref, path)
         refname = ref.decode("utf-8", "replace")
@@ -566,7 +772,7 @@ def log(owner, repo, ref, path):
 @repo.route("/<owner>/<repo>/log/<path:ref>/rss.xml")
 def log_rss(owner, repo, ref):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         commit, ref, _ = lookup_ref(git_repo, ref, None)
         if not isinstance(commit, pygit2.Commit):
             abort(404)
@@ -586,8 +792,8 @@ def log_rss(owner, repo, ref):
 @repo.route("/<owner>/<repo>/commit/<path:ref>")
 def commit(owner, repo, ref):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
-        mailmap = pygit2.Mailmap.from_repository(git_repo)
+    with open_repository(repo.path) as git_repo:
+        mailmap = get_mailmap(git_repo)
         commit, ref, _ = lookup_ref(git_repo, ref, None)
         if not isinstance(commit, pygit2.Commit):
             abort(404)
@@ -603,57 +809,54 @@ def commit(owner, repo, ref):
 @repo.route("/<owner>/<repo>/commit/<path:ref>.patch")
 def patch(owner, repo, ref):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         commit, ref, _ = lookup_ref(git_repo, ref, None)
         if not isinstance(commit, pygit2.Commit):
             abort(404)
-        try:
-            commit = git_repo.revparse_single(ref)
-        except KeyError:
-            abort(404)
-        if isinstance(commit, pygit2.Tag):
-            ref = git_repo.get(commit.target)
-        try:
-            subp = subprocess.run([
-                "git",
-                "--git-dir", repo.path,
-                "format-patch",
-                "--stdout", "-1",
-                "--full-index",
-                "--no-signature",
-                "--end-of-options",
-                str(commit.id)
-            ], timeout=10, stdout=subprocess.PIPE, stderr=sys.stderr)
-        except subprocess.TimeoutExpired:
-            return "Operation timed out", 500
-        if subp.returncode != 0:
-            return "Error preparing patch", 500
-        return Response(subp.stdout, mimetype='text/plain')
+
+        # The patch of a commit never changes
+        etag = str(commit.id)
+        if request.if_none_match.contains_weak(etag):
+            response = make_response("", 304)
+            response.set_etag(etag)
+            return response
+
+        key = f"git.sr.ht:patch:{commit.id}:v1"
+        cached = get_render_cache(key)
+        if cached is None:
+            try:
+                diff = patch_diff(git_repo, commit)
+            except PatchTooLarge:
+                return "Patch too large, clone the repository instead", 413
+            if diff is None:
+                if len(commit.parents) > 1:
+                    return "Merge commits have no patch", 404
+                return "This commit changes nothing and has no patch", 404
+
+        if cached is not None:
+            response = Response(cached, mimetype='text/plain')
+        else:
+            def generate():
+                chunks = []
+                for chunk in format_patch(git_repo, commit, diff):
+                    chunks.append(chunk)
+                    yield chunk
+                set_render_cache(key, timedelta(days=7), b"".join(chunks))
+            response = Response(generate(), mimetype='text/plain')
+        response.set_etag(etag)
+        return response
 
 @repo.route("/<owner>/<repo>/refs")
 def refs(owner, repo):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         if git_repo.is_empty:
             return render_empty_repo(owner, repo, "refs")
 
-        mailmap = pygit2.Mailmap.from_repository(git_repo)
+        mailmap = get_mailmap(git_repo)
 
-        tags = [(
-                ref,
-                git_repo.get(git_repo.references[ref.decode('utf-8')].target),
-                lookup_signature(git_repo, ref.decode('utf-8'))[1]
-            ) for ref in git_repo.raw_listall_references()
-              if ref.startswith(b"refs/tags/")]
-        tags = [tag for tag in tags
-                if isinstance(tag[1], pygit2.Commit) or isinstance(tag[1], pygit2.Tag)]
-        def _tag_key(tag):
-            if isinstance(tag[1], pygit2.Commit):
-                return tag[1].commit_time
-            elif isinstance(tag[1], pygit2.Tag):
-                return _tag_key([None, tag[1].get_object()])
-            return 0
-        tags = sorted(tags, key=_tag_key, reverse=True)
+        tags = [info for info in tag_index(git_repo)
+                if info.type in ("commit", "tag")]
         branches = [(
                 branch,
                 git_repo.branches[branch],
@@ -683,6 +886,11 @@ def refs(owner, repo):
         else:
             page = 0
             tags = tags[:results_per_page]
+        tags = [(
+                info.raw_name,
+                git_repo.get(info.target),
+                lookup_signature(git_repo, info.name)[1]
+            ) for info in tags]
 
         tip = git_repo.get(default_branch.raw_target)
         license_exists, licenses = get_license_info_for_tip(tip)
@@ -700,7 +908,7 @@ def refs(owner, repo):
 def licenses(owner, repo):
     owner, repo = get_repo_or_redir(owner, repo)
 
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         if git_repo.is_empty:
             return render_empty_repo(owner, repo, "licenses")
 
@@ -750,22 +958,9 @@ def search(owner, repo):
 @repo.route("/<owner>/<repo>/refs/rss.xml")
 def refs_rss(owner, repo):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
-        references = [(
-                ref,
-                git_repo.get(git_repo.references[ref.decode('utf-8')].target),
-                lookup_signature(git_repo, ref.decode('utf-8'))[1]
-            ) for ref in git_repo.raw_listall_references()
-              if ref.startswith(b"refs/tags/")]
-
-    def _tag_key(tag):
-        if isinstance(tag[1], pygit2.Commit):
-            return tag[1].commit_time
-        elif isinstance(tag[1], pygit2.Tag):
-            return _tag_key([None, tag[1].get_object()])
-        return 0
-
-    references = sorted(references, key=_tag_key, reverse=True)[:20]
+    with open_repository(repo.path) as git_repo:
+        references = [(info.raw_name, git_repo.get(info.target))
+                for info in tag_index(git_repo)[:20]]
 
     repo_name = f"{repo.owner.canonical_name}/{repo.name}"
     title = f"{repo_name} refs"
@@ -778,7 +973,7 @@ def refs_rss(owner, repo):
 @repo.route("/<owner>/<repo>/refs/<path:ref>")
 def ref(owner, repo, ref):
     owner, repo = get_repo_or_redir(owner, repo)
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         try:
             tag = git_repo.revparse_single(ref)
         except KeyError:
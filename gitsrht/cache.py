@@ -0,0 +1,220 @@
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from prometheus_client import Counter, Gauge
+from srht.cache import get_cache, set_cache
+from srht.config import cfg
+from srht.redis import redis
+
+class LRUCache:
+    """
+    A thread-safe, in-process LRU cache. Each entry weighs 1, or
+    weigh(value) if given, and least recently used entries are evicted to
+    keep the total weight under size.
+    """
+    def __init__(self, size, weigh=None):
+        self.size = size
+        self.weight = 0
+        self._weigh = weigh or (lambda value: 1)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        weight = self._weigh(value)
+        if weight > self.size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.weight -= self._weigh(self._entries[key])
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self.weight += weight
+            while self.weight > self.size:
+                _, evicted = self._entries.popitem(last=False)
+                self.weight -= self._weigh(evicted)
+
+class RenderTimeout(Exception):
+    """
+    Raised by render functions which could not finish in time. The fallback
+    is served in place of their result, which is not cached.
+    """
+    pass
+
+_render_cache_hits = Counter("gitsrht_render_cache_hits",
+        "Number of rendered files served from cache", ["tier"])
+_render_cache_misses = Counter("gitsrht_render_cache_misses",
+        "Number of rendered files missing from every cache tier")
+_render_cache_stored = Counter("gitsrht_render_cache_stored_bytes",
+        "Bytes of rendered files written to the shared cache", ["encoding"])
+_render_cache_local = Gauge("gitsrht_render_cache_local_bytes",
+        "Bytes of rendered files held in this process")
+
+_local_size = int(cfg("git.sr.ht", "render-cache-size", default=str(64 << 20)))
+_local = LRUCache(_local_size, weigh=len)
+
+# Shared cache entries larger than this are stored compressed, prefixed with
+# a NUL byte, which a version string never starts with
+_compress_threshold = 4096
+_compressed = b"\0"
+
+def _read_render_cache(key):
+    # Returns the bytes cached under key and the tier they came from, without
+    # counting the lookup
+    data = _local.get(key)
+    if data is not None:
+        return data, "local"
+    data = get_cache(key)
+    if not data:
+        return None, None
+    if data.startswith(_compressed):
+        data = zlib.decompress(data[len(_compressed):])
+    _local.set(key, data)
+    _render_cache_local.set(_local.weight)
+    return data, "shared"
+
+def get_render_cache(key):
+    """
+    Returns the bytes cached under key, from this process if possible, or
+    None if nothing is cached.
+    """
+    data, tier = _read_render_cache(key)
+    if data is None:
+        _render_cache_misses.inc()
+    else:
+        _render_cache_hits.labels(tier).inc()
+    return data
+
+def set_render_cache(key, expiration, data):
+    """
+    Caches bytes under key in this process and in redis, compressed if they
+    are large.
+    """
+    _local.set(key, data)
+    _render_cache_local.set(_local.weight)
+    if len(data) > _compress_threshold:
+        data = _compressed + zlib.compress(data)
+        _render_cache_stored.labels("zlib").inc(len(data))
+    else:
+        _render_cache_stored.labels("identity").inc(len(data))
+    set_cache(key, expiration, data)
+
+_max_revalidations = int(cfg("git.sr.ht", "max-background-renders", default="2"))
+_revalidations = threading.BoundedSemaphore(_max_revalidations)
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+
+def get_versioned_cache(key, version):
+    """
+    Returns the value cached under key and whether it was stored by the
+    given version, or (None, False) if nothing is cached.
+    """
+    return _split_version(get_render_cache(key), version)
+
+def _split_version(data, version):
+    if not data:
+        return None, False
+    stored_version, _, value = data.partition(b"\n")
+    return value.decode(), stored_version.decode() == version
+
+def set_versioned_cache(key, version, expiration, value):
+    set_render_cache(key, expiration, (version + "\n" + str(value)).encode())
+
+def _done_revalidating(key):
+    with _revalidating_lock:
+        _revalidating.discard(key)
+    _revalidations.release()
+
+def _revalidate(key, version, expiration, load, render):
+    if not _revalidations.acquire(blocking=False):
+        # Too many re-renders in flight, keep serving the stale entry
+        return
+    with _revalidating_lock:
+        if key in _revalidating:
+            _revalidations.release()
+            return
+        _revalidating.add(key)
+
+    try:
+        content = load()
+    except Exception:
+        _done_revalidating(key)
+        raise
+
+    def run():
+        try:
+            set_versioned_cache(key, version, expiration, render(content))
+        except RenderTimeout:
+            # Keep serving the stale entry, and try again on a later request
+            pass
+        except Exception:
+            logging.exception(f"Failed to re-render {key}")
+        finally:
+            _done_revalidating(key)
+    threading.Thread(target=run, daemon=True).start()
+
+_render_lock_timeout = 60
+_render_wait = float(cfg("git.sr.ht", "render-wait", default="2"))
+
+def _render_once(key, version, expiration, load, render, fallback):
+    # Only the worker holding the lock renders a missing entry, the others
+    # wait for its result, then give up and use the fallback, if any
+    lock_key = f"{key}:lock"
+    if redis.set(lock_key, b"1", nx=True, ex=_render_lock_timeout):
+        try:
+            content = load()
+            try:
+                value = render(content)
+            except RenderTimeout:
+                if fallback is None:
+                    raise
+                return fallback(content)
+            set_versioned_cache(key, version, expiration, value)
+            return value
+        finally:
+            redis.delete(lock_key)
+
+    deadline = time.monotonic() + _render_wait
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        # The request already counted as a miss, polls are not counted
+        data, _ = _read_render_cache(key)
+        value, _ = _split_version(data, version)
+        if value is not None:
+            return value
+    content = load()
+    if fallback is not None:
+        return fallback(content)
+    return render(content)
+
+def get_or_render(key, version, expiration, load, render, fallback=None):
+    """
+    Returns the rendering cached under key, or render(load()) on a miss,
+    which is then cached.
+
+    Entries stored by an older version are served as-is while they are
+    re-rendered in the background, so that bumping a version does not make
+    every request render synchronously. At most max-background-renders
+    re-renders run at once per process. load() always runs in the calling
+    thread, so it may use thread-local state such as pooled repositories.
+
+    A miss is rendered by a single worker at a time. Concurrent requests for
+    the same key wait up to render-wait seconds for its result, after which
+    they return fallback(load()) without caching it, or render it
+    themselves if there is no fallback.
+    """
+    value, current = get_versioned_cache(key, version)
+    if value is not None:
+        if not current:
+            _revalidate(key, version, expiration, load, render)
+        return value
+
+    return _render_once(key, version, expiration, load, render, fallback)
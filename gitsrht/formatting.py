@@ -1,13 +1,97 @@
+import fnmatch
+import html as _html
+import multiprocessing
 import os.path
 import pygments
+import pygments.lexers
+import re
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from datetime import timedelta
+from gitsrht.cache import RenderTimeout, get_or_render
 from jinja2 import Template
-from markupsafe import Markup
+from markupsafe import Markup, escape
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
-from pygments.lexers import guess_lexer, guess_lexer_for_filename, TextLexer
-from srht.cache import get_cache, set_cache
+from pygments.lexers import guess_lexer, TextLexer
+from srht.config import cfg
 from srht.markdown import SRHT_MARKDOWN_VERSION, markdown
+from urllib.parse import urljoin
+
+def _plain_text(content):
+    # Served in place of a render which is in progress elsewhere
+    return f'<div class="highlight"><pre>{escape(content)}</pre></div>'
+
+_render_workers = int(cfg("git.sr.ht", "render-workers", default="2"))
+_render_timeout = float(cfg("git.sr.ht", "render-timeout", default="5"))
+_render_pool = None
+_render_pool_pid = None
+_render_pool_lock = threading.Lock()
+
+def _get_render_pool():
+    global _render_pool, _render_pool_pid
+    with _render_pool_lock:
+        # Web workers may be forked from a process which started a pool
+        if _render_pool is None or _render_pool_pid != os.getpid():
+            _render_pool = ProcessPoolExecutor(_render_workers,
+                    mp_context=multiprocessing.get_context("forkserver"))
+            _render_pool_pid = os.getpid()
+        return _render_pool
+
+def _discard_render_pool(pool):
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _cpu_time_exceeded(signum, frame):
+    raise RenderTimeout()
+
+def _run_limited(fn, args, kwargs):
+    # Runs in a pool process, and gives up after render-timeout seconds of
+    # CPU time, so that a pathological file does not occupy it any longer
+    signal.signal(signal.SIGVTALRM, _cpu_time_exceeded)
+    signal.setitimer(signal.ITIMER_VIRTUAL, _render_timeout)
+    try:
+        return str(fn(*args, **kwargs))
+    except RenderTimeout:
+        return None
+    finally:
+        signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+
+def _offload(fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) in the render process pool, so that rendering
+    does not hold the GIL of the web worker, and returns its result as a
+    string, or None if it used more than render-timeout seconds of CPU time.
+
+    Raises RenderTimeout if the pool cannot return a result in time, e.g.
+    because it is busy with other renders.
+    """
+    pool = _get_render_pool()
+    try:
+        future = pool.submit(_run_limited, fn, args, kwargs)
+    except BrokenProcessPool:
+        _discard_render_pool(pool)
+        raise RenderTimeout()
+    try:
+        # Leaves time for queueing, and for a render which is cut off
+        return future.result(timeout=2 * _render_timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise RenderTimeout()
+    except BrokenProcessPool:
+        # A pool process died, e.g. running out of memory
+        _discard_render_pool(pool)
+        raise RenderTimeout()
+
+def _render_markdown(raw):
+    html = _offload(markdown, raw)
+    return html if html is not None else _plain_text(raw)
 
 def get_formatted_readme(file_finder, content_getter, link_prefix=None):
     readme_names = ['README.md', 'README.markdown', 'README']
@@ -18,32 +102,69 @@ def get_formatted_readme(file_finder, content_getter, link_prefix=None):
                 user_obj, link_prefix=link_prefix)
     return None
 
+_link_attr_re = re.compile(r'\b(href|src)="([^"]*)"')
+_url_scheme_re = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*:')
+
+def prefix_links(html, link_prefix):
+    """
+    Resolves the relative links of rendered HTML against link_prefix, which
+    is either a prefix for all links, or a pair of prefixes for links and
+    for images. Renders are cached without prefixes, so that identical
+    files in different repositories share a cache entry.
+    """
+    if not link_prefix:
+        return html
+    if isinstance(link_prefix, str):
+        link_prefix = [link_prefix, link_prefix]
+
+    def resolve(match):
+        attr, url = match[1], _html.unescape(match[2])
+        if not url or url.startswith(("#", "/")) or _url_scheme_re.match(url):
+            return match[0]
+        # Prefixes name a directory, with or without a trailing slash
+        prefix = link_prefix[0] if attr == "href" else link_prefix[1]
+        prefix = prefix.rstrip("/") + "/"
+        return f'{attr}="{escape(urljoin(prefix, url))}"'
+
+    return _link_attr_re.sub(resolve, html)
+
 def format_readme(content_hash, name, content_getter, user_obj, link_prefix=None):
     """
     Formats a `README` file for display on a repository's summary page.
     """
 
-    cache_key = f"git.sr.ht:readme:{content_hash}:{link_prefix}:v{SRHT_MARKDOWN_VERSION}:v10"
-    html = get_cache(cache_key)
-    if html:
-        return Markup(html.decode())
-
-    try:
-        raw = content_getter(user_obj)
-    except:
-        raw = "Error decoding readme - is it valid UTF-8?"
+    def load():
+        try:
+            return content_getter(user_obj)
+        except:
+            return "Error decoding readme - is it valid UTF-8?"
 
     basename, ext = os.path.splitext(name)
-    if ext in ['.md', '.markdown']:
-        html = markdown(raw,
-                link_prefix=link_prefix)
-    else:
-        # Unsupported/unknown markup type.
-        html = Template("<pre>{{ readme }}</pre>",
-            autoescape=True).render(readme=raw)
+    markdown = ext in ['.md', '.markdown']
 
-    set_cache(cache_key, timedelta(days=7), html)
-    return Markup(html)
+    def render(raw):
+        if markdown:
+            return _render_markdown(raw)
+        else:
+            # Unsupported/unknown markup type.
+            return Template("<pre>{{ readme }}</pre>",
+                autoescape=True).render(readme=raw)
+
+    # The same blob may be a README of either kind in different repositories
+    kind = "md" if markdown else "plain"
+    html = get_or_render(f"git.sr.ht:readme:{content_hash}:{kind}",
+            f"v{SRHT_MARKDOWN_VERSION}:v12", timedelta(days=7), load, render,
+            fallback=_plain_text)
+    return Markup(prefix_links(html, link_prefix))
+
+def get_formatted_markdown(content_hash, content, link_prefix=None):
+    """
+    Renders a Markdown file for display in a repository's browsing UI.
+    """
+    html = get_or_render(f"git.sr.ht:markdown:{content_hash}",
+            f"v{SRHT_MARKDOWN_VERSION}:v3", timedelta(days=7),
+            lambda: content, _render_markdown, fallback=_plain_text)
+    return Markup(prefix_links(html, link_prefix))
 
 def _get_shebang(data):
     if not data.startswith('#!'):
@@ -57,37 +178,185 @@ def _get_shebang(data):
 
     return shebang
 
-def _get_lexer(name, data):
-    try:
-        return guess_lexer_for_filename(name, data)
-    except pygments.util.ClassNotFound:
-        try:
-            shebang = _get_shebang(data)
-            if not shebang:
-                return TextLexer()
+def _build_lexer_map():
+    # Maps file names and extensions to the lexers whose filename patterns
+    # match them, and whether they are primary (rather than alias) patterns.
+    # The few patterns which are not of either form are matched one by one.
+    names, extensions, patterns = dict(), dict(), []
+    for lexer in pygments.lexers._iter_lexerclasses():
+        for primary, globs in ((True, lexer.filenames),
+                (False, lexer.alias_filenames)):
+            for glob in globs:
+                if not re.search(r"[*?\[]", glob):
+                    table, key = names, glob
+                elif re.fullmatch(r"\*\.[^*?\[]+", glob):
+                    table, key = extensions, glob[1:]
+                else:
+                    patterns.append((re.compile(fnmatch.translate(glob)),
+                        lexer, primary))
+                    continue
+                # Like guess_lexer_for_filename, alias patterns take
+                # precedence over primary ones for the same lexer
+                matches = table.setdefault(key, dict())
+                if not primary or lexer not in matches:
+                    matches[lexer] = primary
+    return names, extensions, patterns
+
+_lexer_names, _lexer_extensions, _lexer_patterns = _build_lexer_map()
+_interpreter_lexers = dict()
+_lexers = dict()
+_lexers_lock = threading.Lock()
 
-            return guess_lexer(shebang)
+def _filename_lexer(name, data):
+    name = os.path.basename(name)
+    matches = dict(_lexer_names.get(name, {}))
+    for i, c in enumerate(name):
+        if c == ".":
+            for lexer, primary in _lexer_extensions.get(name[i:], {}).items():
+                if not primary or lexer not in matches:
+                    matches[lexer] = primary
+    for pattern, lexer, primary in _lexer_patterns:
+        if pattern.match(name) and (not primary or lexer not in matches):
+            matches[lexer] = primary
+    if not matches:
+        return None
+    if len(matches) == 1:
+        return next(iter(matches))
+
+    # Ambiguous names, e.g. *.h, are settled by content, exactly as
+    # guess_lexer_for_filename does, but among these candidates only
+    result = []
+    for lexer, primary in matches.items():
+        rv = lexer.analyse_text(data)
+        if rv == 1.0:
+            return lexer
+        result.append((rv, primary, lexer.priority, lexer.__name__, lexer))
+    return max(result)[-1]
+
+def _shebang_lexer(shebang):
+    # Lexers recognize shebangs by the last word which is not an option
+    words = [w for w in re.split(r"[/\\ ]", shebang[2:].strip().lower())
+            if w and not w.startswith("-")]
+    if not words:
+        return TextLexer
+    interpreter = words[-1]
+    lexer = _interpreter_lexers.get(interpreter)
+    if lexer is None:
+        try:
+            lexer = type(guess_lexer(f"#!/usr/bin/{interpreter}"))
         except pygments.util.ClassNotFound:
-            return TextLexer()
+            lexer = TextLexer
+        _interpreter_lexers[interpreter] = lexer
+    return lexer
+
+def _get_lexer(name, data, **options):
+    """
+    Returns a lexer for the given file, which is shared with other files
+    of the same type and must not be modified. Lexers are looked up by file
+    name, then by the interpreter of the shebang, using maps built when
+    this module is loaded. File contents are only analysed when a name
+    matches several lexers.
+    """
+    lexer = _filename_lexer(name, data)
+    if lexer is None:
+        shebang = _get_shebang(data)
+        lexer = _shebang_lexer(shebang) if shebang else TextLexer
+
+    key = (lexer, tuple(sorted(options.items())))
+    instance = _lexers.get(key)
+    if instance is None:
+        with _lexers_lock:
+            instance = _lexers.setdefault(key, lexer(**options))
+    return instance
+
+def _highlight(name, content, sample=None, formatter=None, **options):
+    # sample, if given, is used to guess the lexer instead of content
+    lexer = _get_lexer(name, content if sample is None else sample, **options)
+    return highlight(content, lexer, formatter or HtmlFormatter())
+
+def _render_highlight(name, content, **kwargs):
+    html = _offload(_highlight, name, content, **kwargs)
+    return html if html is not None else _plain_text(content)
 
 def highlight_file(name, content):
-    lexer = _get_lexer(name, content)
-    formatter = HtmlFormatter()
-    html = highlight(content, lexer, formatter)
+    try:
+        html = _render_highlight(name, content)
+    except RenderTimeout:
+        html = _plain_text(content)
     return Markup(html)
 
 def get_highlighted_file(name, content_hash, content, formatter=None):
     """
     Highlights a file for display in a repository's browsing UI.
     """
-    cache_key = f"git.sr.ht:highlight:{content_hash}:v{SRHT_MARKDOWN_VERSION}:v6"
-    html = get_cache(cache_key)
-    if html:
-        return Markup(html.decode())
+    def render(content):
+        return _render_highlight(name, content, formatter=formatter)
 
-    lexer = _get_lexer(name, content)
-    if formatter is None:
-        formatter = HtmlFormatter()
-    html = highlight(content, lexer, formatter)
-    set_cache(cache_key, timedelta(days=7), html)
+    html = get_or_render(f"git.sr.ht:highlight:{content_hash}",
+            f"v{SRHT_MARKDOWN_VERSION}:v7", timedelta(days=7),
+            lambda: content, render, fallback=_plain_text)
     return Markup(html)
+
+def split_lines(content):
+    """
+    Splits content into lines, keeping their line endings, the same way
+    Pygments counts them.
+    """
+    lines = content.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return [line + "\n" for line in lines]
+
+def _highlight_lines(key, name, load, sample):
+    # load() and sample() return the lines to highlight, and those the
+    # lexer is guessed from
+    def render(content):
+        # Leading blank lines would otherwise be dropped, shifting the lines
+        return _render_highlight(name, content,
+                sample="".join(sample()), stripnl=False)
+
+    html = get_or_render(key, f"v{SRHT_MARKDOWN_VERSION}:v7",
+            timedelta(days=7), lambda: "".join(load()), render,
+            fallback=_plain_text)
+    return Markup(html)
+
+def _window_key(content_hash, size, index):
+    return f"git.sr.ht:highlight:{content_hash}:{size}:{index}"
+
+def get_highlighted_window(name, content_hash, lines, index, size):
+    """
+    Highlights the index-th window of size lines of a large file. Windows are
+    highlighted and cached independently, using the lexer guessed from the
+    first window, so that viewing part of a file does not highlight all of it.
+    """
+    return _highlight_lines(_window_key(content_hash, size, index), name,
+            lambda: lines[index * size:(index + 1) * size],
+            lambda: lines[:size])
+
+def _html_lines(html, start, end):
+    # Pygments closes its spans at the end of each line, so the lines of
+    # its output can be sliced like those of the file
+    _, _, body = html.partition("<pre>")
+    body, _, _ = body.rpartition("</pre>")
+    if body.startswith("<span></span>"):
+        body = body[len("<span></span>"):]
+    return "".join(line + "\n" for line in body.split("\n")[start:end])
+
+def get_highlighted_lines(name, content_hash, window, start, count, size):
+    """
+    Highlights count lines of a file from line start (0-based), given a
+    function which returns the lines of its index-th window of size lines.
+    The windows they span are highlighted and cached like those of
+    get_highlighted_window, and the lines are sliced out of them, so that
+    overlapping ranges share the same cache entries.
+    """
+    body = []
+    end = start + count
+    for index in range(start // size, (end - 1) // size + 1):
+        html = _highlight_lines(_window_key(content_hash, size, index), name,
+                lambda index=index: window(index), lambda: window(0))
+        offset = index * size
+        body.append(_html_lines(html,
+            max(start - offset, 0), min(end - offset, size)))
+    return Markup('<div class="highlight"><pre>'
+            + "".join(body) + "</pre></div>")
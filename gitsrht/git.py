@@ -1,12 +1,16 @@
-from collections import deque
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from pygit2 import Repository as GitRepository, Tag
 from markupsafe import Markup, escape
 from stat import filemode
 import pygit2
-import json, re
-from srht.config import get_origin
+import bisect, heapq, io, json, os, re, threading, time
+from gitsrht.cache import LRUCache
+from srht.cache import get_cache, set_cache
+from srht.config import cfg, get_origin
 from srht.markdown import PlainLink
+from srht.redis import redis
 
 def strip_pgp_signature(text):
     if not text.strip().endswith("-----END PGP SIGNATURE-----"):
@@ -59,6 +63,64 @@ def commit_links(message, repo):
 
     return _commit_id_re.sub(commit_link, msg)
 
+# Number of resolved identities memoized per mailmap
+_mailmap_identities = 4096
+
+class CachedMailmap:
+    """
+    Wraps a pygit2.Mailmap, memoizing the most recently resolved identities.
+    An empty mailmap, which is shared by every repository without one,
+    resolves identities to themselves without memoizing them.
+    """
+    def __init__(self, mailmap, empty=False):
+        self.mailmap = mailmap
+        self.empty = empty
+        self._resolved = LRUCache(_mailmap_identities)
+
+    def resolve(self, name, email):
+        if self.empty:
+            return name, email
+        key = (name, email)
+        resolved = self._resolved.get(key)
+        if resolved is None:
+            resolved = self.mailmap.resolve(name, email)
+            self._resolved.set(key, resolved)
+        return resolved
+
+    def resolve_signature(self, sig):
+        name, email = self.resolve(sig.name, sig.email)
+        return pygit2.Signature(name, email, sig.time, sig.offset)
+
+_mailmaps = LRUCache(256)
+
+def get_mailmap(git_repo):
+    """
+    Returns the mailmap of the repository, parsed once per .mailmap blob ID
+    and mailmap configuration.
+    """
+    config = git_repo.config
+    blob_spec = (config["mailmap.blob"]
+            if "mailmap.blob" in config else "HEAD:.mailmap")
+    try:
+        blob_id = str(git_repo.revparse_single(blob_spec).id)
+    except (KeyError, ValueError):
+        blob_id = None
+    mailmap_file = config["mailmap.file"] if "mailmap.file" in config else None
+    file_mtime = None
+    if mailmap_file:
+        try:
+            file_mtime = os.stat(mailmap_file).st_mtime_ns
+        except OSError:
+            pass
+
+    key = (blob_id, mailmap_file, file_mtime)
+    mailmap = _mailmaps.get(key)
+    if mailmap is None:
+        mailmap = CachedMailmap(pygit2.Mailmap.from_repository(git_repo),
+                empty=blob_id is None and file_mtime is None)
+        _mailmaps.set(key, mailmap)
+    return mailmap
+
 def _get_ref(repo, ref):
     return repo._get(ref)
 
@@ -72,10 +134,36 @@ def diff_for_commit(git_repo, commit):
     diff.find_similar(pygit2.GIT_DIFF_FIND_RENAMES)
     return parent, diff
 
+def _path_entry(git_repo, commit_id, path, index):
+    # The (id, filemode) of the tree entry at path is enough to tell whether
+    # a commit may have touched it, without computing a diff. Results are
+    # memoized in index, as most commits are looked up once as a commit and
+    # again as the parent of the previous one.
+    key = (commit_id, path)
+    if key not in index:
+        try:
+            entry = git_repo.get(commit_id).tree[path]
+            index[key] = (entry.id, entry.filemode)
+        except (KeyError, ValueError):
+            index[key] = None
+    return index[key]
+
+def _may_touch_path(git_repo, commit, path, index):
+    """
+    Returns False if commit certainly did not change anything at path,
+    compared to its first parent (which is what diff_for_commit compares
+    against). A True result is only a probable hit and needs a real diff.
+    """
+    entry = _path_entry(git_repo, commit.id, path, index)
+    if not commit.parent_ids:
+        return entry is not None
+    return entry != _path_entry(git_repo, commit.parent_ids[0], path, index)
+
 def get_log(git_repo, commit, path="", commits_per_page=20, until=None):
     commits = list()
+    index = dict()
     for commit in git_repo.walk(commit.id, pygit2.GIT_SORT_NONE):
-        if path:
+        if path and _may_touch_path(git_repo, commit, path, index):
             _, diff = diff_for_commit(git_repo, commit)
             for patch in diff:
                 exact = False
@@ -86,7 +174,7 @@ def get_log(git_repo, commit, path="", commits_per_page=20, until=None):
                 if exact or new_path.startswith(path + "/"):
                     commits.append(commit)
                     break
-        else:
+        elif not path:
             commits.append(commit)
 
         if until is not None and commit == until:
@@ -127,10 +215,133 @@ class Repository(GitRepository):
         return (len(self.raw_listall_branches(pygit2.GIT_BRANCH_LOCAL)) == 0
                 or not self.default_branch())
 
+_pool_size = int(cfg("git.sr.ht", "repository-pool-size", default="16"))
+_mwindow_mapped_limit = cfg("git.sr.ht", "mwindow-mapped-limit", default=None)
+if _mwindow_mapped_limit:
+    pygit2.settings.mwindow_mapped_limit = int(_mwindow_mapped_limit)
+
+def _repository_stamp(path):
+    # Changes whenever refs are packed or packs are added or removed, which
+    # is when a long-lived handle would need to re-read them
+    stamp = []
+    for name in ["packed-refs", os.path.join("objects", "pack")]:
+        try:
+            stamp.append(os.stat(os.path.join(path, name)).st_mtime_ns)
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+class RepositoryPool:
+    """
+    An LRU cache of open repositories, keyed by path. Handles are kept per
+    thread, as a pygit2 repository must not be used by several threads at
+    once.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+
+    def get(self, path):
+        repos = getattr(self._local, "repos", None)
+        if repos is None:
+            repos = self._local.repos = OrderedDict()
+
+        stamp = _repository_stamp(path)
+        cached = repos.pop(path, None)
+        if cached is not None:
+            git_repo, cached_stamp = cached
+            if cached_stamp == stamp:
+                repos[path] = cached
+                return git_repo
+            git_repo.free()
+
+        git_repo = Repository(path)
+        repos[path] = (git_repo, stamp)
+        while len(repos) > self.size:
+            _, (evicted, _) = repos.popitem(last=False)
+            evicted.free()
+        return git_repo
+
+repository_pool = RepositoryPool(_pool_size)
+
+@contextmanager
+def open_repository(path):
+    """
+    Returns a pooled handle for the repository at path. Unlike using
+    Repository as a context manager, the handle is not freed on exit.
+    """
+    yield repository_pool.get(path)
+
+_max_view_size = int(cfg("git.sr.ht", "max-view-size", default="512000"))
+
+class LargeBlob:
+    """
+    Stands in for a blob which is too large to be shown, without its data.
+    """
+    is_binary = False
+
+    def __init__(self, id, size):
+        self.id = id
+        self.size = size
+
+def read_blob(git_repo, blob_id):
+    """
+    Reads a blob for display, or returns a LargeBlob if it is larger than
+    max-view-size. The size is read from the object header first, so large
+    blobs are never inflated.
+    """
+    _, size = git_repo.odb.read_header(blob_id)
+    if size > _max_view_size:
+        return LargeBlob(blob_id, size)
+    return git_repo.get(blob_id)
+
+class BlobReader(io.RawIOBase):
+    """
+    A seekable file over the contents of a blob, which reads from the
+    buffer of the blob without copying all of it.
+    """
+    def __init__(self, blob):
+        self._blob = blob
+        self._view = memoryview(blob)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self._view) - self._pos))
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        elif whence != io.SEEK_SET:
+            raise ValueError(f"Invalid whence ({whence})")
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
 class AnnotatedTreeEntry:
     def __init__(self, repo, entry):
         self._entry = entry
         self._repo = repo
+        self._size = None
         self.commit = None
         if entry is not None:
             self.id = str(entry.id)
@@ -146,6 +357,13 @@ class AnnotatedTreeEntry:
             self.blob = self._repo.get(self.id)
         return self
 
+    @property
+    def size(self):
+        # Read from the object header, so the object is never inflated
+        if self._size is None:
+            _, self._size = self._repo.odb.read_header(self.id)
+        return self._size
+
     def serialize(self):
         return {
             "id": self.id,
@@ -176,8 +394,333 @@ class AnnotatedTreeEntry:
     def __repr__(self):
         return f"<AnnotatedTreeEntry {self.name} {self.id}>"
 
-def annotate_tree(repo, tree, commit):
-    return [AnnotatedTreeEntry(repo, entry).fetch_blob() for entry in tree]
+_last_commit_timeout = float(cfg("git.sr.ht", "last-commit-timeout", default="1"))
+
+def _subtree_at(git_repo, commit_id, path, index):
+    # Memoized like _path_entry, but for the directory being annotated
+    if commit_id not in index:
+        tree = git_repo.get(commit_id).tree
+        if path:
+            try:
+                tree = tree[path]
+            except (KeyError, ValueError):
+                tree = None
+        if not isinstance(tree, pygit2.Tree):
+            tree = None
+        index[commit_id] = tree
+    return index[commit_id]
+
+def _tree_entry_key(tree, name):
+    if tree is None or name not in tree:
+        return None
+    entry = tree[name]
+    return (entry.id, entry.filemode)
+
+def get_last_commits(git_repo, commit, path, tree):
+    """
+    Returns a dict mapping the name of each entry of tree, the directory at
+    path in commit, to the ID of the newest commit which changed it.
+
+    All entries are resolved in a single history walk, which gives up after
+    last-commit-timeout seconds and leaves the remaining entries out. The
+    walk is then saved, and the next request resumes it where it stopped,
+    so that entries of large trees fill in over a few views. Complete
+    results are cached by tree ID and path, and shared by every descendant
+    commit which has the same tree at path. The same tree at another path
+    has its own history, and is cached separately.
+    """
+    cache_key = f"git.sr.ht:last-commit:{tree.id}:{commit.id}:{path}:v2"
+    cached = get_cache(cache_key)
+    if cached:
+        return json.loads(cached)
+
+    index = dict()
+    deadline = time.monotonic() + _last_commit_timeout
+
+    # Find the commit which introduced this tree, which is where the walk
+    # starts and the key that descendant commits share
+    origin = commit
+    while origin.parent_ids:
+        parent_id = origin.parent_ids[0]
+        parent_tree = _subtree_at(git_repo, parent_id, path, index)
+        if parent_tree is None or parent_tree.id != tree.id:
+            break
+        origin = git_repo.get(parent_id)
+        if time.monotonic() > deadline:
+            return dict()
+
+    origin_key = f"git.sr.ht:last-commit:{tree.id}:{origin.id}:{path}:v2"
+    cached = get_cache(origin_key)
+    if cached:
+        set_cache(cache_key, timedelta(days=7), cached)
+        return json.loads(cached)
+
+    # A walk which ran out of time is saved, and resumed by the next view
+    partial_key = f"git.sr.ht:last-commit-partial:{tree.id}:{origin.id}:{path}:v1"
+    partial = get_cache(partial_key)
+    if partial:
+        partial = json.loads(partial)
+        last_commits = partial["last_commits"]
+        frontier = [tuple(item) for item in partial["frontier"]]
+    else:
+        last_commits = dict()
+        frontier = [(-origin.commit_time, str(origin.id))]
+
+    pending = {entry.raw_name.decode("utf-8", "replace"):
+            (entry.id, entry.filemode) for entry in tree}
+    for name in last_commits:
+        pending.pop(name, None)
+
+    # Walks newest commits first, like GIT_SORT_TIME, with the queue of
+    # commits yet to be visited kept where it can be saved
+    heapq.heapify(frontier)
+    queued = {commit_id for _, commit_id in frontier}
+    while frontier and pending:
+        if time.monotonic() > deadline:
+            break
+        _, commit_id = heapq.heappop(frontier)
+        queued.discard(commit_id)
+        c = git_repo.get(commit_id)
+        for parent in c.parents:
+            if str(parent.id) not in queued:
+                queued.add(str(parent.id))
+                heapq.heappush(frontier, (-parent.commit_time, str(parent.id)))
+
+        subtree = _subtree_at(git_repo, c.id, path, index)
+        if subtree is None:
+            continue
+        parents = [_subtree_at(git_repo, p, path, index)
+                for p in c.parent_ids]
+        # Nothing here changed relative to a parent it is identical to
+        if any(p is not None and p.id == subtree.id for p in parents):
+            continue
+        for name, key in list(pending.items()):
+            if _tree_entry_key(subtree, name) != key:
+                continue
+            if any(_tree_entry_key(p, name) == key for p in parents):
+                continue
+            last_commits[name] = str(c.id)
+            del pending[name]
+
+    if pending and frontier:
+        set_cache(partial_key, timedelta(days=1), json.dumps({
+            "last_commits": last_commits,
+            "frontier": frontier,
+        }))
+    else:
+        data = json.dumps(last_commits)
+        set_cache(origin_key, timedelta(days=7), data)
+        set_cache(cache_key, timedelta(days=7), data)
+    return last_commits
+
+def annotate_tree(repo, tree, commit, path=None):
+    entries = [AnnotatedTreeEntry(repo, entry) for entry in tree]
+    if path is not None:
+        last_commits = get_last_commits(repo, commit, path, tree)
+        for entry in entries:
+            commit_id = last_commits.get(entry.name)
+            entry.commit = repo.get(commit_id) if commit_id else None
+    return entries
+
+# Number of blamed commits remembered per file, any of which later commits
+# may be blamed incrementally from
+_recent_blames = 8
+# Blames are shared by first-parent ancestors up to this far back which
+# have the same version of the file
+_blame_origin_depth = 100
+# Ranges of lines are blamed in aligned blocks of this many lines, like
+# highlighted windows, so that overlapping ranges share cached blames
+_blame_block = int(cfg("git.sr.ht", "highlight-window", default="2000"))
+
+class BlameHunk:
+    """
+    Consecutive lines of a file which were last changed by the same commit.
+    """
+    def __init__(self, commit_id, lines_in_hunk, committer_name,
+            committer_email, time):
+        self.final_commit_id = commit_id
+        self.lines_in_hunk = lines_in_hunk
+        self.committer_name = committer_name
+        self.committer_email = committer_email
+        # The author time, as shown by commit_time
+        self.time = datetime.fromtimestamp(time, timezone.utc).replace(tzinfo=None)
+
+def _blame_origin(git_repo, commit, path):
+    # A commit which does not change the file has the same blame as its
+    # first parent, so the oldest such ancestor is where its blame is cached.
+    # Which ancestor that is never changes, so it is cached too, and history
+    # is only walked the first time a commit is blamed.
+    origin_key = f"git.sr.ht:blame-origin:{commit.id}:{path}:v1"
+    cached = get_cache(origin_key)
+    if cached:
+        origin = git_repo.get(cached.decode())
+        if origin is not None:
+            return origin
+
+    index = dict()
+    entry = _path_entry(git_repo, commit.id, path, index)
+    origin = commit
+    for _ in range(_blame_origin_depth):
+        if not origin.parent_ids:
+            break
+        parent_id = origin.parent_ids[0]
+        if _path_entry(git_repo, parent_id, path, index) != entry:
+            break
+        origin = git_repo.get(parent_id)
+    set_cache(origin_key, timedelta(days=7), str(origin.id))
+    return origin
+
+def _blame_key(commit_id, path, lines=None):
+    if lines is None:
+        return f"git.sr.ht:blame:{commit_id}:{path}:v1"
+    first, last = lines
+    return f"git.sr.ht:blame-range:{commit_id}:{first}-{last}:{path}:v1"
+
+def _slice_blame(hunks, starts, start, count):
+    # Yields the (commit ID, lines) of count lines from line start (0-based)
+    # of a blame, given the line each of its hunks starts at
+    i = bisect.bisect_right(starts, start) - 1
+    end = start + count
+    while start < end:
+        commit_id, lines = hunks[i]
+        n = min(starts[i] + lines, end) - start
+        yield commit_id, n
+        start += n
+        i += 1
+
+def _hunk_starts(hunks):
+    starts = [0]
+    for _, lines in hunks:
+        starts.append(starts[-1] + lines)
+    return starts
+
+def _blame_lines(hunks, first, last):
+    # Slices the lines from first to last (counted from 1) out of a blame
+    return list(_slice_blame(hunks, _hunk_starts(hunks),
+        first - 1, last - first + 1))
+
+def _nearest_blame(git_repo, commit, path, recent_key):
+    # Returns the nearest ancestor of commit among those recently blamed,
+    # and its cached blame
+    nearest, nearest_distance = None, None
+    for commit_id in redis.lrange(recent_key, 0, -1):
+        commit_id = pygit2.Oid(hex=commit_id.decode())
+        if commit_id == commit.id or commit_id not in git_repo:
+            continue
+        if not git_repo.descendant_of(commit.id, commit_id):
+            continue
+        distance, _ = git_repo.ahead_behind(commit.id, commit_id)
+        if nearest is None or distance < nearest_distance:
+            nearest, nearest_distance = commit_id, distance
+    if nearest is None:
+        return None, None
+    cached = get_cache(_blame_key(nearest, path))
+    if not cached:
+        return None, None
+    return nearest, json.loads(cached)
+
+def _blame(git_repo, commit, path, ancestor=None, base=None, lines=None):
+    # Blames the file, or the given lines of it, re-using the blame of an
+    # ancestor for the lines it last changed. Returns None if they cannot be
+    # traced back to it.
+    commits = dict()
+    hunks = list()
+    def add(commit_id, lines):
+        if hunks and hunks[-1][0] == commit_id:
+            hunks[-1][1] += lines
+        else:
+            hunks.append([commit_id, lines])
+
+    if base is not None:
+        starts = _hunk_starts(base["hunks"])
+
+    min_line, max_line = lines or (None, None)
+    blame = git_repo.blame(path, newest_commit=commit.id,
+            oldest_commit=ancestor, min_line=min_line, max_line=max_line)
+    for hunk in blame:
+        if base is not None and hunk.final_commit_id == ancestor:
+            if hunk.orig_path != path:
+                return None
+            for commit_id, lines in _slice_blame(base["hunks"], starts,
+                    hunk.orig_start_line_number - 1, hunk.lines_in_hunk):
+                commits[commit_id] = base["commits"][commit_id]
+                add(commit_id, lines)
+            continue
+        commit_id = str(hunk.final_commit_id)
+        if commit_id not in commits:
+            final_commit = git_repo.get(hunk.final_commit_id)
+            commits[commit_id] = [final_commit.committer.name,
+                    final_commit.committer.email, final_commit.author.time]
+        add(commit_id, hunk.lines_in_hunk)
+    return {"commits": commits, "hunks": hunks}
+
+def _blame_blocks(git_repo, origin, path, first, last, line_count):
+    # Blames the blocks of lines which first to last span, each of which is
+    # cached on its own, and slices the lines out of them
+    commits = dict()
+    hunks = list()
+    start = (first - 1) // _blame_block * _blame_block + 1
+    for start in range(start, last + 1, _blame_block):
+        block = (start, min(start + _blame_block - 1, line_count))
+        key = _blame_key(origin.id, path, block)
+        cached = get_cache(key)
+        if cached:
+            result = json.loads(cached)
+        else:
+            result = _blame(git_repo, origin, path, lines=block)
+            set_cache(key, timedelta(days=7), json.dumps(result))
+        commits.update(result["commits"])
+        for commit_id, count in result["hunks"]:
+            if hunks and hunks[-1][0] == commit_id:
+                hunks[-1][1] += count
+            else:
+                hunks.append([commit_id, count])
+    offset = (first - 1) // _blame_block * _blame_block
+    return {"commits": commits,
+            "hunks": _blame_lines(hunks, first - offset, last - offset)}
+
+def get_blame(git_repo, commit, path, lines=None, line_count=None):
+    """
+    Returns the blame of the file at path in commit, as a list of BlameHunk,
+    or of the (first, last) range of lines of it, counted from 1, in a file
+    of line_count lines.
+
+    Blames are cached by commit and path. A commit whose blame is not cached
+    is blamed back to the nearest of the last few commits blamed for the
+    same file which is its ancestor, and lines older than that are taken
+    from the cached blame of the ancestor. A range of lines is sliced from
+    the blame of the whole file if it is cached, and otherwise from blames
+    of the blocks of highlight-window lines it spans, which are cached on
+    their own.
+    """
+    origin = _blame_origin(git_repo, commit, path)
+    key = _blame_key(origin.id, path)
+    cached = get_cache(key)
+    if cached:
+        result = json.loads(cached)
+        hunks = result["hunks"]
+        if lines is not None:
+            hunks = _blame_lines(hunks, *lines)
+    elif lines is not None:
+        result = _blame_blocks(git_repo, origin, path, *lines, line_count)
+        hunks = result["hunks"]
+    else:
+        recent_key = f"git.sr.ht:blame-recent:{git_repo.path}:{path}"
+        ancestor, base = _nearest_blame(git_repo, origin, path, recent_key)
+        result = None
+        if base is not None:
+            result = _blame(git_repo, origin, path, ancestor, base)
+        if result is None:
+            result = _blame(git_repo, origin, path)
+        set_cache(key, timedelta(days=7), json.dumps(result))
+        redis.lpush(recent_key, str(origin.id))
+        redis.ltrim(recent_key, 0, _recent_blames - 1)
+        redis.expire(recent_key, timedelta(days=7))
+        hunks = result["hunks"]
+
+    commits = result["commits"]
+    return [BlameHunk(commit_id, count, *commits[commit_id])
+            for commit_id, count in hunks]
 
 def _diffstat_mark_up(anchor, delta, data_s):
     return Markup(
@@ -0,0 +1,448 @@
+import pygit2
+import re
+from datetime import datetime, timedelta, timezone
+from srht.config import cfg
+
+# Patches are formatted as by git format-patch --stdout -1 --full-index
+# --no-signature, so that mailing list tools and git am treat them the same
+# as patches produced by git itself. The formatting rules below follow
+# git's pretty.c and diff.c.
+
+_max_patch_size = int(cfg("git.sr.ht", "max-patch-size",
+    default=str(16 << 20)))
+
+# Width of the diffstat and of wrapped headers, as used by format-patch
+_stat_width = 72
+_header_width = 78
+_rfc2047_width = 76
+
+_days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+_months = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+        "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+_space = " \t\n\v\f\r"
+_rfc822_specials = set('()<>[]:;@,."\\')
+_c_escapes = {
+    0x07: b"\\a", 0x08: b"\\b", 0x09: b"\\t", 0x0a: b"\\n",
+    0x0b: b"\\v", 0x0c: b"\\f", 0x0d: b"\\r",
+    0x22: b'\\"', 0x5c: b"\\\\",
+}
+_abbreviated_index = re.compile(rb"^index [0-9a-f]+\.\.[0-9a-f]+(?= |\n)",
+        re.MULTILINE)
+_similarity_index = re.compile(rb"^similarity index \d+%", re.MULTILINE)
+_file_labels = re.compile(rb"^(?:---|\+\+\+) .*$", re.MULTILINE)
+
+class PatchTooLarge(Exception):
+    """
+    Raised for commits whose patch would exceed max-patch-size.
+    """
+    pass
+
+def patch_diff(git_repo, commit):
+    """
+    Returns the diff a patch of the commit is made of, or None if git
+    format-patch would skip the commit, as it does for merges and commits
+    which change nothing. Raises PatchTooLarge if the blobs it changes add
+    up to more than max-patch-size, which is checked from their object
+    headers before the diff is computed.
+    """
+    if len(commit.parents) > 1:
+        return None
+    flags = pygit2.GIT_DIFF_SHOW_BINARY | pygit2.GIT_DIFF_INDENT_HEURISTIC
+    if commit.parents:
+        diff = commit.parents[0].tree.diff_to_tree(commit.tree, flags=flags)
+    else:
+        diff = commit.tree.diff_to_tree(flags=flags, swap=True)
+    if not len(diff):
+        return None
+
+    size = 0
+    blob_ids = {diff_file.id for delta in diff.deltas
+            for diff_file in (delta.old_file, delta.new_file)
+            if diff_file.mode not in (0, pygit2.GIT_FILEMODE_COMMIT)}
+    for blob_id in blob_ids:
+        size += git_repo.odb.read_header(blob_id)[1]
+        if size > _max_patch_size:
+            raise PatchTooLarge()
+    diff.find_similar(pygit2.GIT_DIFF_FIND_RENAMES)
+    return diff
+
+def _non_ascii(text):
+    return any(ord(ch) > 0x7f or ch == "\033" for ch in text)
+
+def _wrap(text, indent1, indent2, width):
+    # A port of strbuf_add_wrapped_text, for ASCII text. A negative indent1
+    # is the width already taken on the first line.
+    out = []
+    at = lambda i: text[i] if i < len(text) else ""
+    i = bol = 0
+    w = indent = indent1
+    space = None
+    if indent < 0:
+        w = -indent
+        space = 0
+    while True:
+        c = at(i)
+        if c and c not in _space:
+            w += 1
+            i += 1
+            continue
+        new_line = False
+        if w <= width or space is None:
+            start = bol
+            if not c and i == start:
+                break
+            if space is not None:
+                start = space
+            else:
+                out.append(" " * indent)
+            out.append(text[start:i])
+            if not c:
+                break
+            space = i
+            if c == "\t":
+                w |= 0x07
+            elif c == "\n":
+                space += 1
+                if at(space) == "\n":
+                    out.append("\n")
+                    new_line = True
+                elif not at(space).isalnum():
+                    new_line = True
+                else:
+                    out.append(" ")
+            if not new_line:
+                w += 1
+                i += 1
+                continue
+        out.append("\n")
+        i = bol = space + (1 if at(space) and at(space) in _space else 0)
+        space = None
+        w = indent = indent2
+    return "".join(out)
+
+def _rfc2047(text, line_len, address):
+    # Q-encodes text, which starts line_len columns into a header
+    out = ["=?UTF-8?q?"]
+    line_len += len("=?UTF-8?q?")
+    for ch in text:
+        data = ch.encode("utf-8", "surrogateescape")
+        special = (len(data) > 1 or ch in "=?_" or not ch.isprintable()
+                or ord(ch) > 0x7e or ch in _space)
+        if not special and address:
+            special = not (ch.isalnum() or ch in "!*+-/")
+        encoded = "".join(f"={b:02X}" for b in data) if special else ch
+        if line_len + len(encoded) + 2 > _rfc2047_width:
+            out.append("?=\n =?UTF-8?q?")
+            line_len = len("=?UTF-8?q?") + 1
+        out.append(encoded)
+        line_len += len(encoded)
+    out.append("?=")
+    return "".join(out)
+
+def _needs_rfc2047(text):
+    return _non_ascii(text) or "\n" in text or "=?" in text
+
+def _from_header(name, email):
+    header = "From: "
+    width = _header_width
+    if _needs_rfc2047(name):
+        header += _rfc2047(name, len(header), address=True)
+        width = _rfc2047_width
+    else:
+        if any(ch in _rfc822_specials for ch in name):
+            name = '"' + re.sub(r'(["\\])', r"\\\1", name) + '"'
+        header += _wrap(name, -len(header), 1, width)
+    last_line = header.rsplit("\n", 1)[-1]
+    if width < len(last_line) + len(" <") + len(email) + len(">"):
+        header += "\n"
+    return f"{header} <{email}>\n"
+
+def _date_header(signature):
+    tz = timezone(timedelta(minutes=signature.offset))
+    date = datetime.fromtimestamp(signature.time, tz)
+    offset = abs(signature.offset)
+    sign = "-" if signature.offset < 0 else "+"
+    return (f"Date: {_days[date.weekday()]}, {date.day} "
+            f"{_months[date.month - 1]} {date.year} "
+            f"{date.hour:02}:{date.minute:02}:{date.second:02} "
+            f"{sign}{offset // 60:02}{offset % 60:02}\n")
+
+def _decode(data, encoding):
+    try:
+        return data.decode(encoding or "utf-8", "surrogateescape")
+    except LookupError:
+        return data.decode("utf-8", "surrogateescape")
+
+def _split_message(message):
+    # Returns the subject, which is the first paragraph joined into one
+    # line, and the body, with trailing whitespace trimmed from each line
+    lines = [line.rstrip(_space) for line in message.split("\n")]
+    while lines and not lines[0]:
+        lines.pop(0)
+    subject = []
+    while lines and lines[0]:
+        subject.append(lines.pop(0))
+    while lines and not lines[0]:
+        lines.pop(0)
+    return " ".join(subject), "\n".join(lines).rstrip(_space)
+
+def _email_header(commit):
+    encoding = commit.message_encoding
+    message = _decode(commit.raw_message, encoding)
+    subject, body = _split_message(message)
+
+    header = f"From {commit.id} Mon Sep 17 00:00:00 2001\n"
+    header += _from_header(_decode(commit.author.raw_name, encoding),
+            _decode(commit.author.raw_email, encoding))
+    header += _date_header(commit.author)
+    prefix = "Subject: [PATCH] "
+    if _needs_rfc2047(subject):
+        header += prefix + _rfc2047(subject, len(prefix), address=False)
+    else:
+        header += prefix + _wrap(subject, -len(prefix), 1, _header_width)
+    header += "\n"
+    if _non_ascii(message):
+        header += ("MIME-Version: 1.0\n"
+                "Content-Type: text/plain; charset=UTF-8\n"
+                "Content-Transfer-Encoding: 8bit\n")
+    header += "\n"
+    if body:
+        header += body + "\n"
+    return header.encode("utf-8", "surrogateescape")
+
+def _quote_path(path):
+    # C-style quoting of paths, as with core.quotePath
+    if not any(b < 0x20 or b >= 0x7f or b in (0x22, 0x5c) for b in path):
+        return path
+    out = [b'"']
+    for b in path:
+        if b in _c_escapes:
+            out.append(_c_escapes[b])
+        elif b < 0x20 or b >= 0x7f:
+            out.append(b"\\%03o" % b)
+        else:
+            out.append(bytes([b]))
+    out.append(b'"')
+    return b"".join(out)
+
+def _rename_name(old, new):
+    # Shows a rename as a{old => new}b, around the longest common leading
+    # and trailing directories
+    if _quote_path(old) != old or _quote_path(new) != new:
+        return _quote_path(old) + b" => " + _quote_path(new)
+    prefix = 0
+    for i in range(min(len(old), len(new))):
+        if old[i] != new[i]:
+            break
+        if old[i] == ord("/"):
+            prefix = i + 1
+    suffix = 0
+    old_end, new_end = old + b"\0", new + b"\0"
+    i, j = len(old), len(new)
+    adjust = 1 if prefix else 0
+    while (prefix - adjust <= i and prefix - adjust <= j
+            and old_end[i] == new_end[j]):
+        if old_end[i] == ord("/"):
+            suffix = len(old) - i
+        i -= 1
+        j -= 1
+    old_mid = old[prefix:max(len(old) - suffix, prefix)]
+    new_mid = new[prefix:max(len(new) - suffix, prefix)]
+    if not prefix + suffix:
+        return old_mid + b" => " + new_mid
+    return (old[:prefix] + b"{" + old_mid + b" => " + new_mid + b"}"
+            + old[len(old) - suffix:])
+
+def _span_hashes(data, is_text):
+    # Counts the bytes of each span of data, which end at newlines or after
+    # 64 bytes, by the hash of the span
+    counts = {}
+    n = accum1 = accum2 = 0
+    size = len(data)
+    for i, c in enumerate(data):
+        if is_text and c == 0x0d and i + 1 < size and data[i + 1] == 0x0a:
+            continue
+        accum1, accum2 = (((accum1 << 7) ^ (accum2 >> 25)) + c) & 0xffffffff, \
+                ((accum2 << 7) ^ (accum1 >> 25)) & 0xffffffff
+        n += 1
+        if n < 64 and c != 0x0a:
+            continue
+        hashval = (accum1 + accum2 * 0x61) % 107927
+        counts[hashval] = counts.get(hashval, 0) + n
+        n = accum1 = accum2 = 0
+    if n:
+        hashval = (accum1 + accum2 * 0x61) % 107927
+        counts[hashval] = counts.get(hashval, 0) + n
+    return counts
+
+def _similarity(git_repo, delta):
+    # The similarity of renamed files as estimated by git, which libgit2
+    # scores differently
+    old, new = delta.old_file, delta.new_file
+    if old.id == new.id:
+        return 100
+    old_data, new_data = git_repo[old.id].data, git_repo[new.id].data
+    is_text = not delta.is_binary
+    old_spans = _span_hashes(old_data, is_text)
+    new_spans = _span_hashes(new_data, is_text)
+    copied = sum(min(count, new_spans[hashval])
+            for hashval, count in old_spans.items() if hashval in new_spans)
+    max_size = max(len(old_data), len(new_data))
+    return copied * 60000 // max_size * 100 // 60000
+
+def _scale(value, width, max_change):
+    if not value:
+        return 0
+    return 1 + value * (width - 1) // max_change
+
+def _diffstat(git_repo, patches, similarities):
+    # A port of show_stats and diff_summary for format-patch's width
+    files = []
+    changes = []
+    for patch in patches:
+        delta = patch.delta
+        old, new = delta.old_file, delta.new_file
+        if delta.is_binary:
+            stats = [True] + [git_repo.odb.read_header(f.id)[1]
+                    if f.mode not in (0, pygit2.GIT_FILEMODE_COMMIT) else 0
+                    for f in (new, old)]
+        else:
+            stats = [False, *patch.line_stats[1:]]
+        if (delta.status == pygit2.GIT_DELTA_ADDED and changes
+                and changes[-1][0] == pygit2.GIT_DELTA_DELETED
+                and changes[-1][3] == new.raw_path
+                and not stats[0] and not files[-1][1]):
+            # libgit2 splits type changes into a deletion and an addition,
+            # which git shows as a single change
+            _, old_mode, _, path, _, _ = changes.pop()
+            changes.append((pygit2.GIT_DELTA_TYPECHANGE, old_mode, new.mode,
+                path, path, 0))
+            files[-1][2] += stats[1]
+            files[-1][3] += stats[2]
+            continue
+        if delta.status == pygit2.GIT_DELTA_RENAMED:
+            name = _rename_name(old.raw_path, new.raw_path)
+        else:
+            name = _quote_path(new.raw_path)
+        files.append([name, *stats])
+        changes.append((delta.status, old.mode, new.mode,
+            old.raw_path, new.raw_path, similarities.get(new.raw_path)))
+
+    max_len = max(len(name) for name, *_ in files)
+    max_change = max([added + deleted
+        for _, binary, added, deleted in files if not binary] or [0])
+    bin_width = max([14 + len(str(added)) + len(str(deleted))
+        for _, binary, added, deleted in files if binary] or [0])
+    number_width = max(len(str(max_change)), 3 if bin_width else 0)
+    width = max(_stat_width, 16 + 6 + number_width)
+    graph_width = max_change if max_change + 4 > bin_width else bin_width - 4
+    name_width = max_len
+    if name_width + number_width + 6 + graph_width > width:
+        if graph_width > width * 3 // 8 - number_width - 6:
+            graph_width = max(width * 3 // 8 - number_width - 6, 6)
+        if name_width > width - number_width - 6 - graph_width:
+            name_width = width - number_width - 6 - graph_width
+        else:
+            graph_width = width - number_width - 6 - name_width
+
+    out = []
+    adds = dels = 0
+    for name, binary, added, deleted in files:
+        prefix = b""
+        if name_width < len(name):
+            prefix = b"..."
+            length = max(name_width - 3, 0)
+            name = name[len(name) - length:]
+            slash = name.find(b"/")
+            if slash >= 0:
+                name = name[slash:]
+        else:
+            length = name_width
+        padding = b" " * max(length - len(name), 0)
+        line = b" " + prefix + name + padding + b" | "
+        if binary:
+            line += b"Bin".rjust(number_width)
+            if added or deleted:
+                line += b" %d -> %d bytes" % (deleted, added)
+            out.append(line + b"\n")
+            continue
+        adds += added
+        dels += deleted
+        add, delete = added, deleted
+        if graph_width <= max_change:
+            total = _scale(add + delete, graph_width, max_change)
+            if total < 2 and add and delete:
+                total = 2
+            if add < delete:
+                add = _scale(add, graph_width, max_change)
+                delete = total - add
+            else:
+                delete = _scale(delete, graph_width, max_change)
+                add = total - delete
+        line += str(added + deleted).rjust(number_width).encode()
+        if added + deleted:
+            line += b" "
+        out.append(line + b"+" * add + b"-" * delete + b"\n")
+
+    summary = b" %d file%s changed" % (len(files), b"" if len(files) == 1 else b"s")
+    if adds or not dels:
+        summary += b", %d insertion%s(+)" % (adds, b"" if adds == 1 else b"s")
+    if dels or not adds:
+        summary += b", %d deletion%s(-)" % (dels, b"" if dels == 1 else b"s")
+    out.append(summary + b"\n")
+
+    for status, old_mode, new_mode, old_path, new_path, similarity in changes:
+        if status == pygit2.GIT_DELTA_DELETED:
+            out.append(b" delete mode %06o %s\n" % (old_mode, _quote_path(old_path)))
+        elif status == pygit2.GIT_DELTA_ADDED:
+            out.append(b" create mode %06o %s\n" % (new_mode, _quote_path(new_path)))
+        elif status == pygit2.GIT_DELTA_RENAMED:
+            out.append(b" rename %s (%d%%)\n" % (
+                _rename_name(old_path, new_path), similarity))
+            if old_mode != new_mode:
+                out.append(b" mode change %06o => %06o\n" % (old_mode, new_mode))
+        elif old_mode != new_mode:
+            out.append(b" mode change %06o => %06o %s\n" % (
+                old_mode, new_mode, _quote_path(new_path)))
+    return b"".join(out)
+
+def _file_label(match):
+    # git ends file names which contain spaces with a tab
+    line = match.group(0)
+    return line + b"\t" if b" " in line[4:] else line
+
+def _file_patch(patch, similarity):
+    # libgit2 abbreviates the object IDs of text diffs, and names both files
+    # of diffs without hunks, such as those adding empty files, which git
+    # leaves out
+    delta = patch.delta
+    data = _abbreviated_index.sub(
+            f"index {delta.old_file.id}..{delta.new_file.id}".encode(),
+            patch.data, count=1)
+    if similarity is not None:
+        data = _similarity_index.sub(b"similarity index %d%%" % similarity,
+                data, count=1)
+    if not patch.hunks and not delta.is_binary:
+        return re.sub(rb"^--- .*\n\+\+\+ .*\n\Z", b"", data, flags=re.MULTILINE)
+    # Only the file names before the first hunk are labels
+    header, hunks = data.split(b"\n@@", 1) if patch.hunks else (data, None)
+    header = _file_labels.sub(_file_label, header)
+    return header if hunks is None else header + b"\n@@" + hunks
+
+def format_patch(git_repo, commit, diff):
+    """
+    Yields the patch of a commit, made of the diff from patch_diff, in
+    chunks of one file each. Every file is diffed once, for the diffstat,
+    and its patch is kept to be formatted after it; patch_diff has already
+    bounded their size.
+    """
+    similarities = {delta.new_file.raw_path: _similarity(git_repo, delta)
+            for delta in diff.deltas
+            if delta.status == pygit2.GIT_DELTA_RENAMED}
+    patches = list(diff)
+    yield (_email_header(commit) + b"---\n"
+            + _diffstat(git_repo, patches, similarities) + b"\n")
+    for patch in patches:
+        yield _file_patch(patch,
+                similarities.get(patch.delta.new_file.raw_path))
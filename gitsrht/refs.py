@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import pygit2
+from datetime import timedelta
+from gitsrht.cache import LRUCache
+from srht.cache import get_cache, set_cache
+
+def ref_snapshot(git_repo, *namespaces):
+    """
+    Returns a key which changes whenever a reference of the repository is
+    created, updated or deleted, without reading any of them. Loose refs are
+    replaced by renaming a lock file over them, which updates the mtime of
+    their directory. If namespaces are given, such as "refs/tags", only
+    refs under them are watched, along with packed refs.
+    """
+    digest = hashlib.sha1(git_repo.path.encode())
+    try:
+        st = os.stat(os.path.join(git_repo.path, "packed-refs"))
+        digest.update(f"packed-refs:{st.st_mtime_ns}:{st.st_size}".encode())
+    except FileNotFoundError:
+        pass
+    for namespace in namespaces or ("refs",):
+        for dirpath, _, _ in os.walk(os.path.join(git_repo.path, namespace)):
+            try:
+                st = os.stat(dirpath)
+            except FileNotFoundError:
+                continue
+            digest.update(f"{dirpath}:{st.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+def _repo_key(git_repo):
+    return hashlib.sha1(git_repo.path.encode()).hexdigest()
+
+def _decode_name(raw_name):
+    return raw_name.decode("utf-8", "replace")
+
+def _type_str(obj):
+    return obj.type_str if hasattr(obj, "type_str") else obj.type
+
+_decorations = LRUCache(64)
+
+def _build_decorations(git_repo):
+    decorations = dict()
+    for raw_name in git_repo.raw_listall_references():
+        if not raw_name.startswith((b"refs/heads/", b"refs/tags/")):
+            continue
+        name = _decode_name(raw_name)
+        target = git_repo.references[name].target
+        if not isinstance(target, pygit2.Oid):
+            continue
+        if raw_name.startswith(b"refs/tags/"):
+            obj = git_repo.get(target)
+            if obj is None:
+                continue
+            if isinstance(obj, pygit2.Tag):
+                target = obj.target
+        decorations.setdefault(str(target), []).append(name)
+    return decorations
+
+def ref_decorations(git_repo):
+    """
+    Returns a dict mapping commit IDs to the names of the branches and tags
+    which point at them. The map is rebuilt only when branches or tags
+    change, and the shared cache keeps one map per repository.
+    """
+    snapshot = ref_snapshot(git_repo, "refs/heads", "refs/tags")
+    decorations = _decorations.get(snapshot)
+    if decorations is not None:
+        return decorations
+
+    cache_key = f"git.sr.ht:ref-decorations:{_repo_key(git_repo)}:v2"
+    cached = get_cache(cache_key)
+    cached = json.loads(cached) if cached else None
+    if cached and cached["snapshot"] == snapshot:
+        decorations = cached["decorations"]
+    else:
+        decorations = _build_decorations(git_repo)
+        set_cache(cache_key, timedelta(days=1), json.dumps({
+            "snapshot": snapshot,
+            "decorations": decorations,
+        }))
+    _decorations.set(snapshot, decorations)
+    return decorations
+
+class RefInfo:
+    """
+    The metadata of a tag needed to sort and filter tags without loading
+    their objects.
+    """
+    __slots__ = ["name", "target", "type", "object_type",
+            "commit_time", "author_time"]
+
+    def __init__(self, name, target, type, object_type,
+            commit_time, author_time):
+        self.name = name
+        self.target = target
+        self.type = type
+        # For annotated tags, the type of the tagged object
+        self.object_type = object_type
+        # Committer time of the peeled commit, or 0
+        self.commit_time = commit_time
+        # Author time of the commit, or of the commit an annotated tag points
+        # to directly, or 0
+        self.author_time = author_time
+
+    @property
+    def raw_name(self):
+        return self.name.encode("utf-8")
+
+    def serialize(self):
+        return [self.name, self.target, self.type, self.object_type,
+                self.commit_time, self.author_time]
+
+    @staticmethod
+    def deserialize(res):
+        return RefInfo(*res)
+
+def _ref_info(git_repo, name, target):
+    obj = git_repo.get(target)
+    obj_type = _type_str(obj) if obj is not None else None
+    if isinstance(obj, pygit2.Commit):
+        return RefInfo(name, str(target), obj_type, None,
+                obj.commit_time, obj.author.time)
+    if isinstance(obj, pygit2.Tag):
+        peeled = obj.get_object()
+        object_type = _type_str(peeled)
+        author_time = (peeled.author.time
+                if isinstance(peeled, pygit2.Commit) else 0)
+        while isinstance(peeled, pygit2.Tag):
+            peeled = peeled.get_object()
+        commit_time = (peeled.commit_time
+                if isinstance(peeled, pygit2.Commit) else 0)
+        return RefInfo(name, str(target), obj_type, object_type,
+                commit_time, author_time)
+    return RefInfo(name, str(target), obj_type, None, 0, 0)
+
+_tag_indices = LRUCache(64)
+
+def tag_index(git_repo):
+    """
+    Returns a RefInfo for each tag of the repository, newest commit first.
+
+    The index is kept in an in-process LRU and in the shared cache, which
+    keeps one index per repository. When tags change, it is updated from
+    the previous index, so only new or moved tags have their objects
+    loaded. Other refs, such as branches, do not affect it.
+    """
+    snapshot = ref_snapshot(git_repo, "refs/tags")
+    index = _tag_indices.get(snapshot)
+    if index is not None:
+        return index
+
+    cache_key = f"git.sr.ht:tag-index:{_repo_key(git_repo)}:v2"
+    cached = get_cache(cache_key)
+    cached = json.loads(cached) if cached else None
+    previous = None
+    if cached:
+        previous = [RefInfo.deserialize(res) for res in cached["index"]]
+    if cached and cached["snapshot"] == snapshot:
+        index = previous
+    else:
+        known = {(info.name, info.target): info for info in previous or []}
+
+        index = []
+        for raw_name in git_repo.raw_listall_references():
+            if not raw_name.startswith(b"refs/tags/"):
+                continue
+            name = _decode_name(raw_name)
+            target = git_repo.references[name].target
+            if not isinstance(target, pygit2.Oid):
+                continue
+            info = known.get((name, str(target)))
+            if info is None:
+                info = _ref_info(git_repo, name, target)
+            index.append(info)
+        index.sort(key=lambda info: info.commit_time, reverse=True)
+
+        set_cache(cache_key, timedelta(days=7), json.dumps({
+            "snapshot": snapshot,
+            "index": [info.serialize() for info in index],
+        }))
+    _tag_indices.set(snapshot, index)
+    return index
+
+_signature_notes = LRUCache(256)
+
+def _walk_notes(git_repo, tree, prefix, notes):
+    # Notes trees may fan out into subdirectories named by the leading
+    # digits of the annotated object ID
+    for entry in tree:
+        name = prefix + entry.name
+        if _type_str(entry) == "tree":
+            _walk_notes(git_repo, git_repo.get(entry.id), name, notes)
+        else:
+            notes[name] = str(entry.id)
+
+def signature_notes(git_repo, fmt):
+    """
+    Returns a dict mapping object IDs to the ID of their signature note for
+    the given archive format. The map is cached by the notes commit ID.
+    """
+    try:
+        ref = git_repo.references[f"refs/notes/signatures/{fmt}"]
+    except KeyError:
+        return dict()
+    notes_id = str(ref.target)
+    notes = _signature_notes.get(notes_id)
+    if notes is None:
+        notes = dict()
+        _walk_notes(git_repo, git_repo.get(notes_id).tree, "", notes)
+        _signature_notes.set(notes_id, notes)
+    return notes
@@ -2,7 +2,7 @@ import pygit2
 import xml.etree.ElementTree as ET
 from datetime import datetime, timedelta, timezone
 from flask import Response, url_for
-from gitsrht.git import Repository as GitRepository
+from gitsrht.git import open_repository
 from srht.config import cfg
 
 # Date format used by RSS
@@ -56,7 +56,7 @@ def tag_title_description(tag):
     return str(commit.id), ""
 
 def ref_to_item(repo, reference):
-    with GitRepository(repo.path) as git_repo:
+    with open_repository(repo.path) as git_repo:
         target = git_repo.get(reference.target)
 
     author = target.author if hasattr(target, 'author') else target.get_object().author
@@ -2,7 +2,7 @@ import os
 import sqlalchemy as sa
 import sqlalchemy_utils as sau
 from enum import Enum
-from gitsrht.git import Repository as GitRepository
+from gitsrht.git import repository_pool
 from gitsrht.graphql import AccessMode, Visibility
 from sqlalchemy import event
 from sqlalchemy.dialects import postgresql
@@ -95,7 +95,6 @@ class Repository(Base):
                 name="uq_repo_owner_id_name"),
         )
 
-    _git_repo = None
     id = sa.Column(sa.Integer, primary_key=True)
     rid = sa.Column(postgresql.UUID, unique=True, nullable=False)
     created = sa.Column(sa.DateTime, nullable=False)
@@ -120,8 +119,6 @@ class Repository(Base):
 
     @property
     def git_repo(self):
-        if not self._git_repo:
-            self._git_repo = GitRepository(self.path)
-        return self._git_repo
+        return repository_pool.get(self.path)
 
 from gitsrht.types.artifact import Artifact